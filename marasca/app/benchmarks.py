@@ -0,0 +1,243 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+'''
+Micro-benchmarks of pure-Python code paths, run on synthetic data.
+'''
+
+from __future__ import with_statement
+
+import cPickle as pickle
+import struct
+import tempfile
+import time
+
+import poliqarp
+
+import django.template
+import django.template.loader
+
+import corpus as corpus_module
+import utils.redirect
+from app import rows
+from app import views
+
+class Interp(object):
+
+    def __init__(self, lemma, tag):
+        self.lemma = lemma
+        self.tag = tag
+
+class Segment(object):
+
+    def __init__(self, orth, interps):
+        self.orth = orth
+        self.interps = interps
+        self.href = None
+
+def make_raw_results(n, width=5):
+    '''
+    Return n synthetic results, each consisting of left context, match and
+    right context columns.
+    '''
+    def segments(k):
+        return [
+            Segment(u'orth%d' % i, [Interp(u'lemma%d' % i, 'subst:sg:nom:m1')])
+            for i in xrange(k)
+        ]
+    return [
+        [
+            (poliqarp.LeftContextType, segments(width)),
+            (poliqarp.LeftMatchType, segments(1)),
+            (poliqarp.RightMatchType, []),
+            (poliqarp.RightContextType, segments(width)),
+        ]
+        for i in xrange(n)
+    ]
+
+def bench_make_results(n):
+    corpus = corpus_module.Corpus(id='benchmark', title='Benchmark')
+    settings = views.Settings()
+    raw_results = make_raw_results(n)
+    def run():
+        for result in views.make_results(corpus, 0, raw_results, settings):
+            result.url
+    return run
+
+def bench_settings_getattr(n):
+    keys = list(views.Settings.defaults)
+    def run():
+        for i in xrange(n):
+            # Fresh settings, so that defaults go through __getattr__:
+            settings = views.Settings()
+            for key in keys:
+                getattr(settings, key)
+    return run
+
+def bench_settings_setattr(n):
+    settings = views.Settings()
+    values = [
+        ('results_per_page', (25, 50)),
+        ('left_context_width', (5, 6)),
+        ('random_sample', (0, 1)),
+        ('sort', (False, True)),
+    ]
+    def run():
+        for i in xrange(n):
+            for key, pair in values:
+                setattr(settings, key, pair[i & 1])
+    return run
+
+def bench_result(n):
+    raw_results = make_raw_results(n)
+    url_template = '/benchmark/%d/'
+    flags = views.ColumnFlags(views.Settings())
+    def run():
+        for i, raw_result in enumerate(raw_results):
+            views.Result(i, raw_result, url_template, flags).url
+    return run
+
+def bench_compact_results(n):
+    raw_results = make_raw_results(n)
+    def run():
+        # What happens to cached results between requests:
+        compact_results = rows.encode_results(raw_results)
+        compact_results = pickle.loads(pickle.dumps(compact_results, pickle.HIGHEST_PROTOCOL))
+        for result in compact_results:
+            for ctype, segments in result:
+                for segment in segments:
+                    segment.orth
+    return run
+
+def make_metadata(n):
+    '''
+    Return n synthetic lists of raw metadata, as got from poliqarpd.
+    '''
+    return [
+        [
+            (u'autor', u'Autor %d' % i),
+            (u'tytuł', u'Tytuł %d' % i),
+            (u'data wydania', poliqarp.Date(1990 + i % 20, 1, 1)),
+            (u'data pierwszego wydania', poliqarp.Date(1950 + i % 40, 1, 1)),
+            (u'wydawca', u'Wydawca'),
+            (u'miejsce wydania', u'Warszawa'),
+            (u'styl', u'publicystyczny'),
+            (u'styl', u'literatura faktu'),
+            (u'medium', u'prasa'),
+        ]
+        for i in xrange(n)
+    ]
+
+def bench_enhance_metadata(n):
+    corpus = corpus_module.OldIpiCorpus(id='benchmark', title='Benchmark')
+    metadata = make_metadata(n)
+    def run():
+        for tuples in metadata:
+            for key, values in corpus.enhance_metadata(tuples).iteritems():
+                unicode(key)
+                for value in values:
+                    unicode(value)
+    return run
+
+def bench_enhance_metadata_batch(n):
+    corpus = corpus_module.OldIpiCorpus(id='benchmark', title='Benchmark')
+    metadata = make_metadata(n)
+    def run():
+        for result in corpus.enhance_metadata_batch(metadata):
+            for key, values in result.iteritems():
+                unicode(key)
+                for value in values:
+                    unicode(value)
+    return run
+
+def bench_map_getitem(n):
+    format = '<QI'
+    file = tempfile.NamedTemporaryFile()
+    for i in xrange(n):
+        file.write(struct.pack(format, i, i))
+    file.flush()
+    map = corpus_module.Map(file.name, format)
+    # The map stays usable after the file is removed:
+    file.close()
+    def run():
+        for i in xrange(n):
+            map[i]
+    return run
+
+def bench_hash_url(n):
+    urls = ['http://example.org/%d' % i for i in xrange(n)]
+    def run():
+        for url in urls:
+            utils.redirect.hash_url(url)
+    return run
+
+def bench_query_table(n):
+    corpus = corpus_module.OldIpiCorpus(id='benchmark', title='Benchmark')
+    settings = views.Settings()
+    settings.show_in_context = 'sl'
+    qinfo = views.QueryInfo()
+    qinfo.results = views.make_results(corpus, 0, make_raw_results(n), settings, url_template='/benchmark/%d/')
+    qinfo.rinfo = None
+    template = django.template.loader.get_template('query-table.html')
+    context = django.template.Context(dict(qinfo=qinfo, selected=corpus))
+    def run():
+        template.render(context)
+    return run
+
+benchmarks = [
+    ('settings_getattr', bench_settings_getattr),
+    ('settings_setattr', bench_settings_setattr),
+    ('result', bench_result),
+    ('make_results', bench_make_results),
+    ('compact_results', bench_compact_results),
+    ('enhance_metadata', bench_enhance_metadata),
+    ('enhance_metadata_batch', bench_enhance_metadata_batch),
+    ('map_getitem', bench_map_getitem),
+    ('hash_url', bench_hash_url),
+    ('query_table', bench_query_table),
+]
+
+def measure(function, repeat):
+    '''
+    Return the best wall-clock time of `repeat` calls to function.
+    '''
+    best = None
+    for i in xrange(repeat):
+        t1 = time.time()
+        function()
+        t2 = time.time()
+        if best is None or t2 - t1 < best:
+            best = t2 - t1
+    return best
+
+def load_baseline(path):
+    '''
+    Read a baseline file: a benchmark name and its cost per item in
+    microseconds on each line.
+    '''
+    baseline = {}
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, value = line.split()
+            baseline[name] = float(value)
+    return baseline
+
+def save_baseline(path, timings):
+    with open(path, 'w') as file:
+        for name, value in timings:
+            file.write('%s %.3f\n' % (name, value))
+
+# vim:ts=4 sw=4 et
@@ -0,0 +1,166 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+'''
+Background query jobs.
+
+Jobs are stored on disk, one directory per job, and are run by the
+run_jobs management command, independently of users' sessions.
+'''
+
+import binascii
+import cPickle as pickle
+import errno
+import os
+import re
+import shutil
+import time
+
+from django.conf import settings
+
+from app import spool
+
+# Job priority classes, most urgent first:
+PRIORITIES = ('interactive', 'normal', 'bulk')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_id_re = re.compile('^[0-9a-f]{16}$')
+
+class JobDoesNotExist(Exception):
+    pass
+
+class Job(object):
+
+    def __init__(self, user, corpus_id, query, settings, locale, max_results):
+        self.id = binascii.hexlify(os.urandom(8))
+        self.user = user
+        self.corpus_id = corpus_id
+        self.query = query
+        self.settings = settings
+        self.locale = locale
+        self.max_results = max_results
+        self.priority = get_priority(max_results)
+        self.state = QUEUED
+        self.error = None
+        # Number of saved results:
+        self.n_results = 0
+        # Number of results found so far, including the ones not saved yet:
+        self.n_found = 0
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.retry_after = None
+
+    @property
+    def active(self):
+        return self.state in (QUEUED, RUNNING)
+
+def get_priority(max_results):
+    '''
+    Jobs that need to scan more results get lower priority.
+    '''
+    if max_results <= settings.BUFFER_SIZE:
+        return 'interactive'
+    elif max_results <= settings.BUFFER_SIZE * 10:
+        return 'normal'
+    else:
+        return 'bulk'
+
+def _get_directory(job_id):
+    if not _id_re.match(job_id):
+        raise JobDoesNotExist(job_id)
+    return os.path.join(settings.JOBS_DIRECTORY, job_id)
+
+def _write_atomically(path, obj):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(obj, file, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+
+def save(job):
+    directory = _get_directory(job.id)
+    try:
+        os.mkdir(directory, 0700)
+    except OSError, ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    _write_atomically(os.path.join(directory, 'job'), job)
+
+def load(job_id):
+    try:
+        with open(os.path.join(_get_directory(job_id), 'job'), 'rb') as file:
+            return pickle.load(file)
+    except IOError, ex:
+        if ex.errno == errno.ENOENT:
+            raise JobDoesNotExist(job_id)
+        raise
+
+def load_all():
+    jobs = []
+    for job_id in os.listdir(settings.JOBS_DIRECTORY):
+        try:
+            jobs.append(load(job_id))
+        except JobDoesNotExist:
+            pass
+    return jobs
+
+def remove(job):
+    shutil.rmtree(_get_directory(job.id))
+
+def open_results(job):
+    '''
+    Return a spool writer for results of the job, discarding any results
+    saved before.
+    '''
+    directory = os.path.join(_get_directory(job.id), 'results')
+    shutil.rmtree(directory, ignore_errors=True)
+    return spool.SpoolWriter(directory)
+
+def load_results(job, l, r):
+    '''
+    Return saved results from l to r inclusive.
+    '''
+    results = spool.Spool(os.path.join(_get_directory(job.id), 'results'))
+    try:
+        return results.get_results(l, min(r, job.n_results - 1))
+    finally:
+        results.close()
+
+def pick(queued, running, n_workers):
+    '''
+    Choose the queued job to be started next, or return None.
+
+    More urgent priority classes go first, but only interactive jobs may
+    occupy the last JOB_INTERACTIVE_WORKERS workers; at least one worker is
+    left for the other classes, however few workers there are. Within a
+    class, users with fewer running jobs go first; each user's jobs are run
+    in order of submission.
+    '''
+    if len(running) >= n_workers:
+        return
+    n_reserved = min(settings.JOB_INTERACTIVE_WORKERS, n_workers - 1)
+    n_running = {}
+    for job in running:
+        n_running[job.user] = n_running.get(job.user, 0) + 1
+    for priority in PRIORITIES:
+        if priority != PRIORITIES[0] and len(running) >= n_workers - n_reserved:
+            break
+        candidates = [job for job in queued if job.priority == priority]
+        if candidates:
+            return min(candidates, key=lambda job: (n_running.get(job.user, 0), job.submitted))
+
+# vim:ts=4 sw=4 et
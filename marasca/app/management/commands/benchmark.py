@@ -0,0 +1,71 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+from optparse import make_option
+
+import django.core.management.base
+
+from app import benchmarks
+
+class Command(django.core.management.base.BaseCommand):
+
+    help = 'Run micro-benchmarks and report cost per item, optionally compared with a saved baseline.'
+    args = '[benchmark ...]'
+
+    option_list = django.core.management.base.BaseCommand.option_list + (
+        make_option('-n', '--items', type='int', default=1000,
+            help='number of items per run (default: 1000)'),
+        make_option('-r', '--repeat', type='int', default=5,
+            help='number of runs; the best one is reported (default: 5)'),
+        make_option('-b', '--baseline', metavar='FILE',
+            help='compare with the baseline saved in FILE'),
+        make_option('-s', '--save', metavar='FILE',
+            help='save results as a baseline to FILE'),
+        make_option('-t', '--tolerance', type='float', default=10.0,
+            help='flag changes against the baseline larger than this many percent (default: 10)'),
+    )
+
+    def handle(self, *args, **options):
+        n = options['items']
+        repeat = options['repeat']
+        tolerance = options['tolerance']
+        known = dict(benchmarks.benchmarks)
+        for name in args:
+            if name not in known:
+                raise django.core.management.base.CommandError('Unknown benchmark: %s' % name)
+        baseline = {}
+        if options['baseline'] is not None:
+            try:
+                baseline = benchmarks.load_baseline(options['baseline'])
+            except (IOError, ValueError), ex:
+                raise django.core.management.base.CommandError('Cannot read baseline: %s' % ex)
+        timings = []
+        for name, setup in benchmarks.benchmarks:
+            if args and name not in args:
+                continue
+            best = benchmarks.measure(setup(n), repeat)
+            cost = best * 1e6 / n
+            timings.append((name, cost))
+            line = '%-24s %10.2f µs/item' % (name, cost)
+            if baseline.get(name):
+                change = 100.0 * (cost - baseline[name]) / baseline[name]
+                line += '   %10.2f µs/item  %+7.1f%%' % (baseline[name], change)
+                if change > tolerance:
+                    line += '  SLOWER'
+                elif change < -tolerance:
+                    line += '  faster'
+            self.stdout.write(line + '\n')
+        if options['save'] is not None:
+            benchmarks.save_baseline(options['save'], timings)
+
+# vim:ts=4 sw=4 et
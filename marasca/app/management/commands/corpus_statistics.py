@@ -0,0 +1,56 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+from optparse import make_option
+
+import multiprocessing
+
+import django.core.management.base
+from django.conf import settings
+
+import corpus.statistics as corpus_statistics
+
+class Command(django.core.management.base.BaseCommand):
+
+    help = 'Compute statistics of corpora from their index files.'
+    args = '[corpus ...]'
+
+    option_list = django.core.management.base.BaseCommand.option_list + (
+        make_option('-j', '--processes', type='int', default=multiprocessing.cpu_count(),
+            help='number of processes scanning the index files (default: number of CPUs)'),
+    )
+
+    def handle(self, *args, **options):
+        corpora = dict((corpus.id, corpus) for corpus in settings.CORPORA)
+        for corpus_id in args:
+            if corpus_id not in corpora:
+                raise django.core.management.base.CommandError('Unknown corpus: %s' % corpus_id)
+            if corpora[corpus_id].segment_index is None:
+                raise django.core.management.base.CommandError('Index layout of %s is not configured' % corpus_id)
+        n_processes = options['processes']
+        pool = multiprocessing.Pool(n_processes)
+        try:
+            for corpus in settings.CORPORA:
+                if args and corpus.id not in args:
+                    continue
+                if corpus.segment_index is None or corpus.path is None:
+                    continue
+                # A few parts per process even out differences in speed:
+                statistics = corpus_statistics.compute(corpus, pool, 4 * n_processes)
+                corpus_statistics.save(corpus, statistics)
+                self.stdout.write('%s: %d segments, %d documents\n' % (corpus.id, statistics.n_segments, statistics.n_documents))
+        finally:
+            pool.close()
+            pool.join()
+
+# vim:ts=4 sw=4 et
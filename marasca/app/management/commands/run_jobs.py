@@ -0,0 +1,137 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+from optparse import make_option
+
+import sys
+import threading
+import time
+import traceback
+
+import django.core.management.base
+from django.conf import settings
+
+import poliqarp
+
+from app import jobs
+from app import spool
+from app import views
+
+class JobConnection(views.BaseConnection):
+
+    def __init__(self, job):
+        self.__session_name = 'job/%s' % job.id
+        views.BaseConnection.__init__(self)
+
+    def get_default_session_name(self):
+        return self.__session_name
+
+def run_job(job):
+    '''
+    Run the job, saving results one poliqarpd buffer at a time.
+
+    poliqarpd sorts only the results in its buffer, so a job with sorting on
+    is given a buffer big enough for all of its results.
+    '''
+    buffer_size = settings.BUFFER_SIZE
+    sort_args = None
+    if job.settings['sort']:
+        sort_args = views.get_sort_args(job.settings)
+        buffer_size = max(buffer_size, job.max_results)
+    job.n_results = job.n_found = 0
+    connection = JobConnection(job)
+    try:
+        connection.make_session()
+        views.sync_settings(job.locale, job.settings, connection, views.get_new_session_calls(buffer_size))
+        connection.open_corpus(job.corpus_id)
+        connection.make_query(job.query, force=True)
+        results = jobs.open_results(job)
+        for n_stored, running in connection.run_buffers(buffer_size, timeout=settings.JOB_PROGRESS_INTERVAL):
+            if running:
+                job.n_found = job.n_results + n_stored
+                jobs.save(job)
+                continue
+            n = min(n_stored, job.max_results - job.n_results)
+            if sort_args is not None:
+                connection.sort(*sort_args)
+            if n > 0:
+                results.append(connection.get_results(0, n - 1))
+            job.n_found = job.n_results = job.n_results + n
+            jobs.save(job)
+            if job.n_results >= job.max_results:
+                break
+        results.close()
+        job.state = jobs.DONE
+    except poliqarp.Busy:
+        # Try again later.
+        job.state = jobs.QUEUED
+        job.retry_after = time.time() + settings.JOB_RETRY_INTERVAL
+    except poliqarp.InvalidQuery, ex:
+        job.state = jobs.FAILED
+        job.error = unicode(ex)
+    except Exception:
+        job.state = jobs.FAILED
+        # The details are for the administrator, not for the user:
+        sys.stderr.write('Job %s failed:\n%s' % (job.id, traceback.format_exc()))
+    finally:
+        connection.close()
+    if not job.active:
+        job.finished = time.time()
+    jobs.save(job)
+
+class Command(django.core.management.base.BaseCommand):
+
+    help = 'Run background query jobs.'
+
+    option_list = django.core.management.base.BaseCommand.option_list + (
+        make_option('-w', '--workers', type='int', default=settings.JOB_WORKERS,
+            help='number of jobs run at the same time (default: %d)' % settings.JOB_WORKERS),
+    )
+
+    def handle(self, *args, **options):
+        n_workers = options['workers']
+        running = {}
+        for job in jobs.load_all():
+            if job.state == jobs.RUNNING:
+                # Interrupted by a previous run of this command.
+                job.state = jobs.QUEUED
+                jobs.save(job)
+        last_cleanup = 0
+        while 1:
+            if settings.SPOOL_DIRECTORY is not None and time.time() - last_cleanup >= settings.SPOOL_CLEANUP_INTERVAL:
+                spool.remove_expired()
+                last_cleanup = time.time()
+            for job_id, (job, thread) in running.items():
+                if not thread.isAlive():
+                    del running[job_id]
+            queued = []
+            now = time.time()
+            for job in jobs.load_all():
+                if job.state == jobs.QUEUED:
+                    if job.retry_after is None or job.retry_after < now:
+                        queued.append(job)
+                elif not job.active and job.finished < now - settings.JOB_LIFETIME:
+                    jobs.remove(job)
+            job = jobs.pick(queued, [job for (job, thread) in running.itervalues()], n_workers)
+            if job is None:
+                time.sleep(settings.JOB_POLL_INTERVAL)
+                continue
+            job.state = jobs.RUNNING
+            job.started = time.time()
+            jobs.save(job)
+            thread = threading.Thread(target=run_job, args=(job,))
+            thread.setDaemon(True)
+            thread.start()
+            running[job.id] = (job, thread)
+
+# vim:ts=4 sw=4 et
@@ -0,0 +1,112 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+from optparse import make_option
+
+import glob
+
+import django.core.management.base
+from django.conf import settings
+
+from app import slowlog
+
+def get_default_paths():
+    log_path = settings.SLOW_QUERY_LOG
+    if log_path is None:
+        return []
+    # The current log and the rotated ones, e.g. slow-queries.log.1 or
+    # slow-queries.log.2.gz:
+    return sorted(glob.glob(log_path + '*'))
+
+class QueryStats(object):
+
+    def __init__(self, corpus_id, query):
+        self.corpus_id = corpus_id
+        self.query = query
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.outcomes = {}
+
+    def add(self, entry):
+        self.count += 1
+        self.total += entry['total']
+        self.max = max(self.max, entry['total'])
+        outcome = entry.get('outcome')
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    @property
+    def outcome(self):
+        '''
+        Return the most frequent outcome.
+        '''
+        return max(self.outcomes.iteritems(), key=lambda item: item[1])[0]
+
+class Command(django.core.management.base.BaseCommand):
+
+    help = 'Summarize the slow query log.'
+    args = '[log-file ...]'
+
+    option_list = django.core.management.base.BaseCommand.option_list + (
+        make_option('-n', '--top', type='int', default=20,
+            help='number of queries in each table (default: 20)'),
+        make_option('-c', '--corpus', metavar='CORPUS',
+            help='only consider queries in this corpus'),
+    )
+
+    def write_table(self, title, rows):
+        self.stdout.write('%s\n\n' % title)
+        self.stdout.write('%6s %10s %10s %10s  %-12s %-12s %s\n' % ('count', 'total', 'mean', 'max', 'outcome', 'corpus', 'query'))
+        for stats in rows:
+            line = u'%6d %10.2f %10.2f %10.2f  %-12s %-12s %s\n' % (
+                stats.count, stats.total, stats.mean, stats.max,
+                stats.outcome, stats.corpus_id, stats.query,
+            )
+            self.stdout.write(line.encode('UTF-8'))
+        self.stdout.write('\n')
+
+    def handle(self, *args, **options):
+        paths = args or get_default_paths()
+        if not paths:
+            raise django.core.management.base.CommandError('No slow query log found')
+        queries = {}
+        stages = {}
+        try:
+            for entry in slowlog.read(paths):
+                if options['corpus'] is not None and entry.get('corpus') != options['corpus']:
+                    continue
+                key = entry.get('corpus'), entry.get('query')
+                try:
+                    stats = queries[key]
+                except KeyError:
+                    stats = queries[key] = QueryStats(*key)
+                stats.add(entry)
+                for name, duration in entry.get('stages', {}).iteritems():
+                    stages[name] = stages.get(name, 0.0) + duration
+        except IOError, ex:
+            raise django.core.management.base.CommandError(str(ex))
+        top = options['top']
+        rows = queries.values()
+        rows.sort(key=lambda stats: -stats.total)
+        self.write_table('Queries by total time (s):', rows[:top])
+        rows.sort(key=lambda stats: -stats.mean)
+        self.write_table('Queries by time per request (s):', rows[:top])
+        self.stdout.write('Time by stage (s):\n\n')
+        for name, duration in sorted(stages.iteritems(), key=lambda item: -item[1]):
+            self.stdout.write('%-16s %10.2f\n' % (name, duration))
+
+# vim:ts=4 sw=4 et
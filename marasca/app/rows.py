@@ -0,0 +1,228 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+'''
+Compact representation of query results, for keeping them around.
+
+A result, as got from poliqarpd, is a list of (column type, segments) pairs,
+with an object for every segment and interpretation. The same orths, lemmata
+and tags occur over and over again, so a compact result keeps only two
+arrays:
+
+- ``shape`` — number of columns, then for each column: column type, number
+  of segments, then for each segment: segment id (-1 if unknown), number of
+  interps;
+- ``strings`` — ids of strings in a string table: for each segment, its
+  orth, then lemma and tag of each interp.
+
+A string table is shared only by results that are kept together (a page of
+results, a sample, a result cache), and is pickled along with them.
+
+A result is decoded back into segments whenever it is looked at. The decoded
+form is not kept, so that cached results stay compact; views.Result keeps it
+for the rest of the request.
+'''
+
+from __future__ import with_statement
+
+import array
+import threading
+
+import poliqarp
+
+column_types = [
+    poliqarp.LeftContextType,
+    poliqarp.LeftMatchType,
+    poliqarp.RightMatchType,
+    poliqarp.RightContextType,
+]
+
+class Interp(object):
+
+    __slots__ = ('lemma', 'tag')
+
+    def __init__(self, lemma, tag):
+        self.lemma = lemma
+        self.tag = tag
+
+class Segment(object):
+
+    __slots__ = ('id', 'orth', 'interps', 'href')
+
+    def __init__(self, id, orth, interps):
+        self.id = id
+        self.orth = orth
+        self.interps = interps
+        self.href = None
+
+class StringTable(object):
+
+    '''
+    Interned strings of a set of results. Strings are never removed, so ids
+    stay valid for the lifetime of the table.
+    '''
+
+    def __init__(self, strings=()):
+        self._strings = list(strings)
+        self._ids = dict((s, id) for (id, s) in enumerate(self._strings))
+        self._lock = threading.Lock()
+
+    def intern(self, s):
+        try:
+            return self._ids[s]
+        except KeyError:
+            pass
+        with self._lock:
+            id = self._ids.get(s)
+            if id is None:
+                id = len(self._strings)
+                self._strings.append(s)
+                self._ids[s] = id
+            return id
+
+    def __getitem__(self, id):
+        return self._strings[id]
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __getstate__(self):
+        return (self._strings,)
+
+    def __setstate__(self, state):
+        [strings] = state
+        self.__init__(strings)
+
+class CompactResult(object):
+
+    '''
+    Query result which looks like a list of (column type, segments) pairs.
+    '''
+
+    __slots__ = ('_table', '_shape', '_strings')
+
+    def __init__(self, table, shape, strings):
+        self._table = table
+        self._shape = shape
+        self._strings = strings
+
+    def decode(self):
+        '''
+        Return a new list of (column type, segments) pairs.
+        '''
+        shape = self._shape
+        strings = self._strings
+        table = self._table
+        i = 1
+        j = 0
+        columns = []
+        for c in xrange(shape[0]):
+            ctype = column_types[shape[i]]
+            n_segments = shape[i + 1]
+            i += 2
+            segments = []
+            for s in xrange(n_segments):
+                id, n_interps = shape[i], shape[i + 1]
+                i += 2
+                orth = table[strings[j]]
+                j += 1
+                interps = []
+                for k in xrange(n_interps):
+                    interps.append(Interp(table[strings[j]], table[strings[j + 1]]))
+                    j += 2
+                segments.append(Segment(id if id >= 0 else None, orth, interps))
+            columns.append((ctype, segments))
+        return columns
+
+    def __getitem__(self, n):
+        return self.decode()[n]
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return self._shape[0]
+
+    def __getstate__(self):
+        # Results sharing a table share it in the pickle, too.
+        return self._table, self._shape.tostring(), self._strings.tostring()
+
+    def __setstate__(self, state):
+        table, shape, strings = state
+        self._table = table
+        self._shape = array.array('i')
+        self._shape.fromstring(shape)
+        self._strings = array.array('I')
+        self._strings.fromstring(strings)
+
+def encode_result(table, raw_result):
+    if isinstance(raw_result, CompactResult) and raw_result._table is table:
+        return raw_result
+    shape = array.array('i', [len(raw_result)])
+    strings = array.array('I')
+    intern = table.intern
+    for ctype, segments in raw_result:
+        shape.append(column_types.index(ctype))
+        shape.append(len(segments))
+        for segment in segments:
+            id = getattr(segment, 'id', None)
+            if id is None:
+                id = -1
+            shape.append(id)
+            shape.append(len(segment.interps))
+            strings.append(intern(segment.orth))
+            for interp in segment.interps:
+                strings.append(intern(interp.lemma))
+                strings.append(intern(interp.tag))
+    return CompactResult(table, shape, strings)
+
+def encode_results(raw_results):
+    '''
+    Encode results which are kept together, with a string table of their own.
+    '''
+    table = StringTable()
+    return [encode_result(table, raw_result) for raw_result in raw_results]
+
+class RowStore(object):
+
+    '''
+    String table of a changing set of compact results, such as a cache.
+    Strings of the results that were dropped stay in the table until the
+    owner repacks it, which is due once the table has grown to twice its
+    size after the last repack.
+    '''
+
+    min_size = 4096
+
+    def __init__(self):
+        self._table = StringTable()
+        self._limit = self.min_size
+
+    def encode(self, raw_result):
+        return encode_result(self._table, raw_result)
+
+    def needs_repack(self):
+        return len(self._table) > self._limit
+
+    def repack(self, results):
+        '''
+        Encode the results that are still kept with a new table, which
+        replaces the old one. Return the new results.
+        '''
+        table = StringTable()
+        results = [encode_result(table, result) for result in results]
+        self._table = table
+        self._limit = max(2 * len(table), self.min_size)
+        return results
+
+# vim:ts=4 sw=4 et
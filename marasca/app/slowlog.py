@@ -0,0 +1,138 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+'''
+Log of slow query requests.
+
+Each entry is a single line of JSON, with the corpus, the (normalized)
+query, settings, the outcome and time spent in each stage of the request.
+All processes append to the same file, which is rotated externally (e.g. by
+logrotate); see the slow_queries management command for a summary.
+'''
+
+from __future__ import with_statement
+
+import contextlib
+import gzip
+import logging
+import logging.handlers
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from django.conf import settings
+
+class Trace(object):
+
+    '''
+    Timings of a single request.
+    '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.corpus_id = None
+        self.query = None
+        self.settings = None
+        self.outcome = None
+        self.stages = {}
+        # Whether the response is streamed, and the request is to be
+        # recorded once it has been sent rather than by the middleware:
+        self.deferred = False
+
+    def add(self, name, duration):
+        self.stages[name] = self.stages.get(name, 0.0) + duration
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - t)
+
+    def to_dict(self):
+        return dict(
+            time=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start)),
+            corpus=self.corpus_id,
+            query=self.query,
+            settings=self.settings,
+            outcome=self.outcome,
+            total=time.time() - self.start,
+            stages=self.stages,
+        )
+
+def get_trace(request):
+    trace = getattr(request, 'slowlog_trace', None)
+    if trace is None:
+        trace = request.slowlog_trace = Trace()
+    return trace
+
+_logger = None
+_logger_lock = threading.Lock()
+
+def get_logger():
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            # Reopens the file after it has been rotated:
+            handler = logging.handlers.WatchedFileHandler(settings.SLOW_QUERY_LOG)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger = logging.getLogger('marasca.slowlog')
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            logger.addHandler(handler)
+            _logger = logger
+    return _logger
+
+def record(trace):
+    '''
+    Log the request, if it was a query and it was slow enough.
+    '''
+    if settings.SLOW_QUERY_LOG is None or trace.query is None:
+        return
+    if time.time() - trace.start < settings.SLOW_QUERY_THRESHOLD:
+        return
+    get_logger().info(json.dumps(trace.to_dict(), sort_keys=True))
+
+def read(paths):
+    '''
+    Iterate over entries of the log files, which may be gzipped, skipping
+    damaged lines.
+    '''
+    for path in paths:
+        if path.endswith('.gz'):
+            file = gzip.open(path)
+        else:
+            file = open(path)
+        try:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        finally:
+            file.close()
+
+class SlowQueryMiddleware(object):
+
+    def process_response(self, request, response):
+        trace = getattr(request, 'slowlog_trace', None)
+        if trace is not None and not trace.deferred:
+            record(trace)
+        return response
+
+# vim:ts=4 sw=4 et
@@ -0,0 +1,243 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+'''
+On-disk spool of query results.
+
+A spool is a directory with two files:
+
+- ``records`` — packed results, one after another;
+- ``index`` — offset and length of each record, in fixed-width entries,
+
+so that any result can be read in constant time, without asking poliqarpd.
+
+Record layout (little-endian):
+
+- number of columns (uint16), then for each column:
+- column type (uint8), number of segments (uint16), then for each segment:
+- segment id (int32, -1 if unknown), orth, number of interps (uint16),
+  then for each interp: lemma, tag,
+
+where strings are UTF-8, prefixed with their length (uint16).
+'''
+
+import errno
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+from django.conf import settings
+
+import corpus
+
+from app import rows
+
+_index_format = '<QI'
+_index_size = struct.calcsize(_index_format)
+
+def _pack_string(s):
+    s = s.encode('UTF-8')
+    return struct.pack('<H', len(s)) + s
+
+def _unpack_string(buffer, offset):
+    [length] = struct.unpack_from('<H', buffer, offset)
+    offset += 2
+    return buffer[offset:offset + length].decode('UTF-8'), offset + length
+
+def encode_result(raw_result):
+    chunks = [struct.pack('<H', len(raw_result))]
+    for ctype, segments in raw_result:
+        chunks.append(struct.pack('<BH', rows.column_types.index(ctype), len(segments)))
+        for segment in segments:
+            id = getattr(segment, 'id', None)
+            if id is None:
+                id = -1
+            chunks += [
+                struct.pack('<i', id),
+                _pack_string(segment.orth),
+                struct.pack('<H', len(segment.interps)),
+            ]
+            for interp in segment.interps:
+                chunks += [_pack_string(interp.lemma), _pack_string(interp.tag)]
+    return ''.join(chunks)
+
+def decode_result(buffer, offset):
+    [n_columns] = struct.unpack_from('<H', buffer, offset)
+    offset += 2
+    raw_result = []
+    for i in xrange(n_columns):
+        ctype, n_segments = struct.unpack_from('<BH', buffer, offset)
+        offset += 3
+        segments = []
+        for j in xrange(n_segments):
+            [id] = struct.unpack_from('<i', buffer, offset)
+            orth, offset = _unpack_string(buffer, offset + 4)
+            [n_interps] = struct.unpack_from('<H', buffer, offset)
+            offset += 2
+            interps = []
+            for k in xrange(n_interps):
+                lemma, offset = _unpack_string(buffer, offset)
+                tag, offset = _unpack_string(buffer, offset)
+                interps.append(rows.Interp(lemma, tag))
+            segments.append(rows.Segment(id if id >= 0 else None, orth, interps))
+        raw_result.append((rows.column_types[ctype], segments))
+    return raw_result
+
+class SpoolWriter(object):
+
+    def __init__(self, directory):
+        try:
+            os.mkdir(directory, 0700)
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        self._records = open(os.path.join(directory, 'records'), 'ab')
+        self._index = open(os.path.join(directory, 'index'), 'ab')
+        self._records.seek(0, os.SEEK_END)
+        self._offset = self._records.tell()
+
+    def append(self, raw_results):
+        index = []
+        for raw_result in raw_results:
+            record = encode_result(raw_result)
+            self._records.write(record)
+            index.append(struct.pack(_index_format, self._offset, len(record)))
+            self._offset += len(record)
+        # Readers trust the index, so it must not point past the records:
+        self._records.flush()
+        self._index.write(''.join(index))
+        self._index.flush()
+
+    def close(self):
+        self._records.close()
+        self._index.close()
+
+class Spool(object):
+
+    '''
+    Read-only view of a spool. Results appended after it has been opened
+    are not visible.
+    '''
+
+    def __init__(self, directory):
+        index_path = os.path.join(directory, 'index')
+        self._length = os.path.getsize(index_path) // _index_size
+        if self._length == 0:
+            return
+        self._index = corpus.Map(index_path, _index_format)
+        self._fd = os.open(os.path.join(directory, 'records'), os.O_RDONLY)
+        self._records = mmap.mmap(self._fd, 0, mmap.MAP_SHARED, mmap.PROT_READ)
+
+    def __len__(self):
+        return self._length
+
+    def get_results(self, l, r):
+        '''
+        Return results from l to r inclusive.
+        '''
+        r = min(r, self._length - 1)
+        results = []
+        for n in xrange(l, r + 1):
+            offset, length = self._index[n]
+            results.append(decode_result(self._records[offset:offset + length], 0))
+        return results
+
+    def close(self):
+        if self._length == 0:
+            return
+        self._index.close()
+        self._records.close()
+        os.close(self._fd)
+        self._length = 0
+
+    def __del__(self):
+        self.close()
+
+def get_spool_directory(key):
+    return os.path.join(
+        settings.SPOOL_DIRECTORY,
+        hashlib.sha1(repr(key)).hexdigest()
+    )
+
+def exists(key):
+    return os.path.isdir(get_spool_directory(key))
+
+def open_spool(key):
+    '''
+    Return the complete spool for the key, or None.
+    '''
+    directory = get_spool_directory(key)
+    if not os.path.isdir(directory):
+        return
+    return Spool(directory)
+
+class PendingSpool(object):
+
+    '''
+    Spool being written, a poliqarpd buffer at a time. It becomes visible to
+    readers only once it is committed.
+    '''
+
+    def __init__(self, key):
+        self._directory = get_spool_directory(key)
+        self._tmp_directory = tempfile.mkdtemp(suffix='.tmp', dir=settings.SPOOL_DIRECTORY)
+        self._writer = SpoolWriter(self._tmp_directory)
+
+    def append(self, raw_results):
+        self._writer.append(raw_results)
+
+    def commit(self):
+        self._writer.close()
+        try:
+            os.rename(self._tmp_directory, self._directory)
+        except OSError:
+            # Somebody else has spooled the same results in the meantime.
+            shutil.rmtree(self._tmp_directory)
+
+    def abort(self):
+        self._writer.close()
+        shutil.rmtree(self._tmp_directory, ignore_errors=True)
+
+def write_spool(key, raw_results):
+    '''
+    Spool results of a finished query.
+    The spool becomes visible to readers only once it is complete.
+    '''
+    pending = PendingSpool(key)
+    try:
+        pending.append(raw_results)
+    except:
+        pending.abort()
+        raise
+    pending.commit()
+
+def remove_expired():
+    '''
+    Remove spools, and leftovers of unfinished ones, older than
+    SPOOL_LIFETIME.
+    '''
+    expiry = time.time() - settings.SPOOL_LIFETIME
+    for name in os.listdir(settings.SPOOL_DIRECTORY):
+        directory = os.path.join(settings.SPOOL_DIRECTORY, name)
+        try:
+            if not os.path.isdir(directory) or os.stat(directory).st_mtime >= expiry:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(directory, ignore_errors=True)
+
+# vim:ts=4 sw=4 et
@@ -0,0 +1,257 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+'''
+Local checking and normalization of Poliqarp queries.
+
+The checks are deliberately structural (strings, brackets, operators and
+quantifiers), so that no query which poliqarpd would accept is rejected;
+everything else is still left to poliqarpd.
+
+The normal form differs from the query only in ways that don't change its
+meaning: runs of whitespace are collapsed, whitespace inside brackets and
+around operators is dropped, regular expression flags are sorted, and
+conjunctions of simple conditions in segment specifications are sorted by
+attribute.
+'''
+
+import re
+
+from django.utils.translation import ugettext_lazy
+
+class QuerySyntaxError(ValueError):
+
+    def __init__(self, message, position):
+        ValueError.__init__(self, message, position)
+        self.message = message
+        # Offset of the offending character, counted from 0:
+        self.position = position
+
+STRING = 'string'
+WORD = 'word'
+QUANTIFIER = 'quantifier'
+PUNCTUATION = 'punctuation'
+
+_openers = {'[': ']', '(': ')'}
+_closers = {']': '[', ')': '('}
+
+# Characters which end a word outside and inside segment specifications:
+_word_re = re.compile(r'''[^\s\[\](){}&|!="*+?]+''')
+_inner_word_re = re.compile(r'''[^\s\[\]()&|!="]+''')
+_flags_re = re.compile(r'/([a-zA-Z]+)')
+_quantifier_re = re.compile(r'^(\d*)(?:(,)(\d*))?$')
+_space_re = re.compile(r'\s+')
+
+class Token(object):
+
+    def __init__(self, kind, text, position, space_before):
+        self.kind = kind
+        self.text = text
+        self.position = position
+        # Whether the token was separated by whitespace from the previous one:
+        self.space_before = space_before
+
+    @property
+    def operand(self):
+        return self.kind in (STRING, WORD)
+
+def _read_string(query, i):
+    j = i + 1
+    while j < len(query):
+        if query[j] == '\\':
+            j += 2
+            continue
+        if query[j] == '"':
+            break
+        j += 1
+    else:
+        raise QuerySyntaxError(ugettext_lazy('Unterminated string'), i)
+    j += 1
+    text = query[i:j]
+    match = _flags_re.match(query, j)
+    if match is not None:
+        flags = ''.join(sorted(set(match.group(1))))
+        text += '/' + flags
+        j = match.end()
+    return text, j
+
+def _read_quantifier(query, i):
+    j = query.find('}', i)
+    if j < 0:
+        raise QuerySyntaxError(ugettext_lazy('Unterminated quantifier'), i)
+    spec = _space_re.sub('', query[i + 1:j])
+    match = _quantifier_re.match(spec)
+    if match is None or not (match.group(1) or match.group(3)):
+        raise QuerySyntaxError(ugettext_lazy('Malformed quantifier'), i)
+    lower, comma, upper = match.groups()
+    if lower and upper and int(lower) > int(upper):
+        raise QuerySyntaxError(ugettext_lazy('Lower bound of the quantifier exceeds its upper bound'), i)
+    return '{%s}' % spec, j + 1
+
+def tokenize(query):
+    tokens = []
+    depth = 0
+    i = 0
+    space = False
+    while i < len(query):
+        char = query[i]
+        if char.isspace():
+            space = True
+            i += 1
+            continue
+        if char == '"':
+            text, j = _read_string(query, i)
+            kind = STRING
+        elif char == '{' and depth == 0:
+            text, j = _read_quantifier(query, i)
+            kind = QUANTIFIER
+        elif char in '*+?' and depth == 0:
+            text, j = char, i + 1
+            kind = QUANTIFIER
+        elif query.startswith('!=', i):
+            text, j = '!=', i + 2
+            kind = PUNCTUATION
+        elif char in '[]()&|!=':
+            text, j = char, i + 1
+            kind = PUNCTUATION
+            if char == '[':
+                depth += 1
+            elif char == ']':
+                depth = max(depth - 1, 0)
+        else:
+            word_re = _inner_word_re if depth else _word_re
+            match = word_re.match(query, i)
+            if match is None:
+                raise QuerySyntaxError(ugettext_lazy('Unexpected character'), i)
+            text, j = match.group(), match.end()
+            kind = WORD
+        tokens.append(Token(kind, text, i, space))
+        space = False
+        i = j
+    return tokens
+
+def _check_brackets(tokens):
+    stack = []
+    for token in tokens:
+        if token.kind != PUNCTUATION:
+            continue
+        if token.text in _openers:
+            if token.text == '[' and any(opener.text == '[' for opener in stack):
+                raise QuerySyntaxError(ugettext_lazy('Segment specifications cannot be nested'), token.position)
+            stack.append(token)
+        elif token.text in _closers:
+            if not stack or stack[-1].text != _closers[token.text]:
+                raise QuerySyntaxError(ugettext_lazy('Unmatched closing bracket'), token.position)
+            stack.pop()
+    if stack:
+        raise QuerySyntaxError(ugettext_lazy('Unclosed bracket'), stack[-1].position)
+
+def _ends_operand(token):
+    return token.operand or token.kind == QUANTIFIER or token.text in (']', ')')
+
+def _begins_operand(token):
+    return token.operand or token.text in ('[', '(', '!')
+
+def _check_operators(tokens):
+    for i, token in enumerate(tokens):
+        prev = tokens[i - 1] if i > 0 else None
+        next = tokens[i + 1] if i + 1 < len(tokens) else None
+        if token.kind == QUANTIFIER:
+            if prev is None or not _ends_operand(prev) or prev.kind == QUANTIFIER:
+                raise QuerySyntaxError(ugettext_lazy('Nothing to repeat'), token.position)
+        elif token.kind != PUNCTUATION:
+            continue
+        elif token.text in ('=', '!='):
+            if prev is None or prev.kind != WORD:
+                raise QuerySyntaxError(ugettext_lazy('Missing attribute name'), token.position)
+            if next is None or not next.operand:
+                raise QuerySyntaxError(ugettext_lazy('Missing value'), token.position)
+        elif token.text in ('&', '|'):
+            if prev is None or not _ends_operand(prev):
+                raise QuerySyntaxError(ugettext_lazy('Missing left operand'), token.position)
+            if next is None or not _begins_operand(next):
+                raise QuerySyntaxError(ugettext_lazy('Missing right operand'), token.position)
+        elif token.text == '(':
+            if next is not None and next.text == ')' and next.kind == PUNCTUATION:
+                raise QuerySyntaxError(ugettext_lazy('Empty parentheses'), token.position)
+        elif token.text == '!':
+            if next is None or not _begins_operand(next):
+                raise QuerySyntaxError(ugettext_lazy('Missing operand'), token.position)
+
+def _render(tokens):
+    chunks = []
+    prev = None
+    for token in tokens:
+        if prev is not None:
+            if token.text == '&' or prev.text == '&':
+                space = True
+            elif prev.text in ('[', '(', '!', '=', '!=') and prev.kind == PUNCTUATION:
+                space = False
+            elif token.text in (']', ')', '=', '!=') and token.kind == PUNCTUATION:
+                space = False
+            elif token.kind == QUANTIFIER:
+                space = False
+            else:
+                space = token.space_before
+            if space:
+                chunks.append(' ')
+        chunks.append(token.text)
+        prev = token
+    return ''.join(chunks)
+
+def _sort_conjunction(tokens):
+    '''
+    Sort a segment specification (without the brackets) if it is a plain
+    conjunction of attribute conditions.
+    '''
+    conditions = []
+    for i in xrange(0, len(tokens), 4):
+        condition = tokens[i:i + 3]
+        if len(condition) != 3 or condition[0].kind != WORD or condition[1].text not in ('=', '!=') or not condition[2].operand:
+            return tokens
+        if i + 3 < len(tokens) and tokens[i + 3].text != '&':
+            return tokens
+        conditions.append(condition)
+    conditions.sort(key=_render)
+    result = []
+    for condition in conditions:
+        if result:
+            result.append(Token(PUNCTUATION, '&', None, True))
+        result += condition
+    return result
+
+def normalize(query):
+    '''
+    Check the query; return its normal form.
+    Raise QuerySyntaxError if the query is malformed.
+    '''
+    tokens = tokenize(query)
+    if not tokens:
+        raise QuerySyntaxError(ugettext_lazy('Empty query'), 0)
+    _check_brackets(tokens)
+    _check_operators(tokens)
+    result = []
+    start = None
+    for i, token in enumerate(tokens):
+        if token.kind != PUNCTUATION:
+            pass
+        elif token.text == '[':
+            start = i + 1
+        elif token.text == ']':
+            result += _sort_conjunction(tokens[start:i])
+            start = None
+        if start is None or token.text == '[':
+            result.append(token)
+    return _render(result)
+
+# vim:ts=4 sw=4 et
@@ -0,0 +1,278 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+'''
+Tests of routing poliqarpd sessions across several poliqarpd instances.
+
+Run them from the directory with settings:
+
+    DJANGO_SETTINGS_MODULE=settings python -m unittest app.tests
+'''
+
+from __future__ import with_statement
+
+import errno
+import socket
+import unittest
+
+import django.http
+from django.conf import settings
+from django.utils.importlib import import_module
+
+import utils.routing
+
+from app import views
+
+class FakeBackend(object):
+
+    '''
+    Stand-in for a poliqarpd instance, which can be taken down and brought
+    back up.
+    '''
+
+    def __init__(self, address):
+        self.address = address
+        self.up = True
+        self.sessions = set()
+
+    def check(self):
+        if not self.up:
+            raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+
+class FakeCluster(object):
+
+    '''
+    Several fake poliqarpd instances on the local host, with a router in
+    front of them. Health checks are run only when asked for.
+    '''
+
+    def __init__(self, n_backends, replicas=settings.POLIQARPD_VIRTUAL_NODES):
+        addresses = [('localhost', 4567 + i) for i in xrange(n_backends)]
+        self.backends = dict((address, FakeBackend(address)) for address in addresses)
+        self.router = utils.routing.Router(addresses, replicas, check_in_background=False)
+
+    def check(self, backend):
+        self.backends[backend.address].check()
+        return 0.0
+
+    def install(self):
+        self._saved = (utils.routing.router, utils.routing.check, views.Connection)
+        utils.routing.router = self.router
+        utils.routing.check = self.check
+        FakeConnection.cluster = self
+        views.Connection = FakeConnection
+
+    def uninstall(self):
+        utils.routing.router, utils.routing.check, views.Connection = self._saved
+
+class FakeConnection(views.Connection):
+
+    '''
+    Connection to a backend of a FakeCluster. Sessions are made and
+    resumed; the other commands used by connection_for() only check if the
+    backend is up. Nothing is left to poliqarp.Connection, which would need
+    a socket.
+    '''
+
+    cluster = None
+
+    def connect(self, host=None, port=None):
+        self.fake_backend = self.cluster.backends[host, port]
+
+    def make_session(self):
+        self._memo = None
+        self.fake_backend.check()
+        name = self.get_default_session_name()
+        if name in self.fake_backend.sessions:
+            return False
+        self.fake_backend.sessions.add(name)
+        return True
+
+    def _command(self, *args):
+        self.fake_backend.check()
+
+    suspend_session = resize_buffer = ping = _command
+
+    # See get_backend_settings():
+    set_notification_interval = set_locale = _command
+    set_retrieve_ids = set_retrieve_lemmata = set_retrieve_tags = _command
+    set_left_context_width = set_right_context_width = set_wide_context_width = _command
+    set_random_sample = _command
+
+    def close(self):
+        self._memo = None
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+def make_request():
+    engine = import_module(settings.SESSION_ENGINE)
+    request = django.http.HttpRequest()
+    request.META['REMOTE_ADDR'] = '127.0.0.1'
+    request.LANGUAGE_CODE = settings.LANGUAGE_CODE
+    request.session = engine.SessionStore()
+    request.session.save()
+    return request
+
+class HashRingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = FakeCluster(3)
+        self.backends = self.cluster.router.backends
+        self.keys = ['127.0.0.1/%08x' % i for i in xrange(3000)]
+
+    def test_all_backends(self):
+        ring = utils.routing.HashRing(self.backends, 64)
+        for key in self.keys[:100]:
+            backends = list(ring.iter_backends(key))
+            self.assertEqual(len(backends), len(self.backends))
+            self.assertEqual(set(backends), set(self.backends))
+
+    def test_distribution(self):
+        ring = utils.routing.HashRing(self.backends, 64)
+        counts = dict((backend, 0) for backend in self.backends)
+        for key in self.keys:
+            counts[ring.iter_backends(key).next()] += 1
+        for count in counts.itervalues():
+            self.assertTrue(len(self.keys) / 5 < count < len(self.keys) / 2, counts)
+
+    def test_consistency(self):
+        # Removing a backend moves only these keys that were routed to it.
+        ring = utils.routing.HashRing(self.backends, 64)
+        smaller_ring = utils.routing.HashRing(self.backends[1:], 64)
+        removed = self.backends[0]
+        for key in self.keys:
+            backend = ring.iter_backends(key).next()
+            if backend is not removed:
+                self.assertEqual(smaller_ring.iter_backends(key).next(), backend)
+
+    def test_empty(self):
+        ring = utils.routing.HashRing([], 64)
+        self.assertEqual(list(ring.iter_backends('key')), [])
+
+class RouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = FakeCluster(3)
+        self.router = self.cluster.router
+        self.cluster.install()
+
+    def tearDown(self):
+        self.cluster.uninstall()
+
+    def test_down_and_back(self):
+        key = 'some-session'
+        first, second = list(self.router._ring.iter_backends(key))[:2]
+        self.assertEqual(self.router.route(key), first)
+        self.cluster.backends[first.address].up = False
+        self.router.mark_down(first.address)
+        self.assertFalse(self.router.is_healthy(first.address))
+        self.assertEqual(self.router.route(key), second)
+        self.router.check_all()
+        self.assertFalse(self.router.is_healthy(first.address))
+        self.assertEqual(self.router.route(key), second)
+        self.cluster.backends[first.address].up = True
+        self.router.check_all()
+        self.assertTrue(self.router.is_healthy(first.address))
+        self.assertEqual(self.router.route(key), first)
+
+    def test_failures_needed(self):
+        backend = self.router.backends[0]
+        self.cluster.backends[backend.address].up = False
+        for i in xrange(settings.POLIQARPD_MAX_FAILURES - 1):
+            self.router.check_all()
+            self.assertTrue(backend.healthy)
+        self.router.check_all()
+        self.assertFalse(backend.healthy)
+
+    def test_all_down(self):
+        key = 'some-session'
+        for fake_backend in self.cluster.backends.itervalues():
+            fake_backend.up = False
+        for i in xrange(settings.POLIQARPD_MAX_FAILURES):
+            self.router.check_all()
+        self.assertEqual(self.router.route(key), self.router._ring.iter_backends(key).next())
+
+    def test_unknown_backend(self):
+        self.assertFalse(self.router.is_healthy(('localhost', 1)))
+
+class FailoverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = FakeCluster(3)
+        self.router = self.cluster.router
+        self.cluster.install()
+        self.request = make_request()
+        self.settings = views.get_settings(self.request)
+
+    def tearDown(self):
+        self.request.session.delete()
+        self.cluster.uninstall()
+
+    def connect(self):
+        with views.connection_for(self.request, self.settings) as connection:
+            return connection.backend
+
+    def test_sticky(self):
+        address = self.connect()
+        self.assertEqual(self.connect(), address)
+        self.assertEqual(
+            sum(len(fake_backend.sessions) for fake_backend in self.cluster.backends.itervalues()),
+            1
+        )
+
+    def test_connection_refused(self):
+        # The router doesn't know yet that the backend is down.
+        first = self.connect()
+        self.cluster.backends[first].up = False
+        second = self.connect()
+        self.assertNotEqual(second, first)
+        self.assertFalse(self.router.is_healthy(first))
+        self.assertEqual(len(self.cluster.backends[second].sessions), 1)
+        # The backend comes back, but sessions stay where they are.
+        self.cluster.backends[first].up = True
+        self.router.check_all()
+        self.assertTrue(self.router.is_healthy(first))
+        self.assertEqual(self.connect(), second)
+
+    def test_health_check(self):
+        # The router knows that the backend is down before it is used.
+        first = self.connect()
+        self.cluster.backends[first].up = False
+        for i in xrange(settings.POLIQARPD_MAX_FAILURES):
+            self.router.check_all()
+        second = self.connect()
+        self.assertNotEqual(second, first)
+        self.assertEqual(len(self.cluster.backends[second].sessions), 1)
+
+    def test_commands_faked(self):
+        # Anything missing from FakeConnection would be sent to a socket by
+        # poliqarp.Connection.
+        for name in views.get_backend_settings(settings.LANGUAGE_CODE, self.settings.get_dict()):
+            self.assertTrue('set_%s' % name in vars(FakeConnection), name)
+
+    def test_settings_resent(self):
+        # A session made anew on another backend needs the query run again.
+        first = self.connect()
+        self.settings.need_query_rerun(False)
+        self.cluster.backends[first].up = False
+        self.connect()
+        self.assertTrue(self.settings.need_query_rerun())
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:ts=4 sw=4 et
@@ -13,9 +13,16 @@
 
 from __future__ import with_statement
 
+import Queue
 import contextlib
+import copy
+import random
+import socket
 import sys
+import threading
 import time
+import urllib
+import zlib
 
 import django.conf
 import django.core.mail
@@ -26,11 +33,21 @@ import django.template.loader
 import django.utils.translation
 import django.views.decorators.cache
 
+import corpus.statistics as corpus_statistics
+import utils.cache
 import utils.locks
 import utils.i18n
 import utils.redirect
+import utils.routing
+import utils.sampling
 import poliqarp
 
+from app import jobs
+from app import rows
+from app import slowlog
+from app import spool
+from app import syntax
+
 get_template = django.template.loader.get_template
 ugettext_lazy = django.utils.translation.ugettext_lazy
 global_settings = django.conf.settings
@@ -53,9 +70,27 @@ def process_index(request):
     context = Context(request)
     return django.http.HttpResponse(template.render(context))
 
+def clean_query(query):
+    '''
+    Reject malformed queries before poliqarpd is bothered; return the
+    normal form of the query, so that equivalent queries share caches.
+    '''
+    try:
+        return syntax.normalize(query)
+    except syntax.QuerySyntaxError, ex:
+        raise django.forms.ValidationError(
+            django.utils.translation.ugettext('%(message)s at character %(position)d') % dict(
+                message=ex.message,
+                position=ex.position + 1,
+            )
+        )
+
 class QueryForm(django.forms.Form):
     query = django.forms.CharField(max_length=1000, label=ugettext_lazy('Query'))
 
+    def clean_query(self):
+        return clean_query(self.cleaned_data['query'])
+
 def get_corpus_by_id(corpus_id):
     for corpus in django.conf.settings.CORPORA:
         if corpus.id == corpus_id:
@@ -89,10 +124,22 @@ class Info(object):
     def _repr(self, key, value):
         return repr(value)
 
+_url_marker = '9' * 20
+
+def reverse_template(view, key, **kwargs):
+    '''
+    Reverse URL for the view, with the `key` argument replaced by a %d
+    placeholder.
+    '''
+    kwargs[key] = _url_marker
+    url = django.core.urlresolvers.reverse(view, kwargs=kwargs)
+    return url.replace('%', '%%').replace(_url_marker, '%d')
+
 class PageInfo(Info):
-    def __init__(self, corpus_id, page_start, n):
+
+    def __init__(self, url_template, page_start, n):
         self.n = n
-        self.url = django.core.urlresolvers.reverse(process_query, kwargs=dict(corpus_id=corpus_id, page_start=page_start))
+        self.url = url_template % page_start
 
 class QueryInfo(Info):
 
@@ -104,6 +151,12 @@ class QueryInfo(Info):
         self.n_spotted_results = None
         self.results = []
         self.selected = None
+        self.sample = False
+        # Whether wide context and metadata of the shown sample item are
+        # still to be fetched, see query_sample():
+        self.fetching = False
+        # Occurrences per million segments of the corpus, if known:
+        self.relative_frequency = None
 
     def _repr(self, key, value):
         if key == 'results':
@@ -129,57 +182,194 @@ class ResultInfo(Info):
         self.context = ('', '', '', '')
         self.metadata = {}
 
-def extract_result_info(connection, settings, corpus, n, extract_context=True, extract_metadata=True):
-    if n >= connection.get_n_stored_results():
+class CachedResult(object):
+
+    # Whether the metadata is already enhanced (see Corpus.enhance_metadata()),
+    # rather than as got from poliqarpd:
+    enhanced = False
+
+    # The raw result is a rows.CompactResult, so that many of them fit in
+    # memory:
+    def __init__(self, raw_result, context, metadata, enhanced=False):
+        self.raw_result = raw_result
+        self.context = context
+        self.metadata = metadata
+        self.enhanced = enhanced
+
+def repack_cached_results(store, cached_results):
+    '''
+    Drop strings of no longer cached results from the store, if it is due.
+    '''
+    if not store.needs_repack():
+        return
+    raw_results = store.repack([cached.raw_result for cached in cached_results])
+    for cached, raw_result in zip(cached_results, raw_results):
+        cached.raw_result = raw_result
+
+class ResultCache(object):
+
+    '''
+    Results of a single query, together with their wide contexts and raw
+    metadata, so that moving between result detail pages doesn't need to
+    touch poliqarpd.
+    '''
+
+    def __init__(self, size):
+        self._key = None
+        self._items = utils.cache.BoundedCache(size)
+        self._rows = rows.RowStore()
+        self._lock = threading.Lock()
+
+    def get(self, key, n):
+        with self._lock:
+            if key != self._key:
+                return
+            return self._items.get(n)
+
+    def put(self, key, n, item):
+        with self._lock:
+            if key != self._key:
+                self._items.clear()
+                self._rows = rows.RowStore()
+                self._key = key
+            item.raw_result = self._rows.encode(item.raw_result)
+            self._items[n] = item
+            repack_cached_results(self._rows, self._items.values())
+
+    def clear(self):
+        with self._lock:
+            self._key = None
+            self._items.clear()
+            self._rows = rows.RowStore()
+
+# Result caches are kept in memory of this process rather than in the
+# session, so that requests which don't need them (keepalives, tooltips, ...)
+# don't pay for pickling them. A request served by another process just
+# misses the cache.
+_result_caches = utils.cache.BoundedCache(global_settings.RESULT_CACHE_SESSIONS)
+_result_caches_lock = threading.Lock()
+
+# Settings that affect what poliqarpd returns for a given result:
+RESULT_CACHE_KEY_SETTINGS = (
+    'random_sample', 'random_sample_size',
+    'sort', 'sort_column', 'sort_type', 'sort_direction',
+    'left_context_width', 'right_context_width', 'wide_context_width',
+)
+
+# Settings that affect contents of query results table (besides the locale,
+# see get_spool_key()):
+SPOOL_KEY_SETTINGS = (
+    'sort', 'sort_column', 'sort_type', 'sort_direction',
+    'left_context_width', 'right_context_width',
+)
+
+# Settings that affect rows of a page of query results; changes of the other
+# ones only need the page to be rendered again:
+PAGE_KEY_SETTINGS = SPOOL_KEY_SETTINGS + ('results_per_page',)
+
+def get_result_cache(request):
+    session_key = request.session.session_key
+    with _result_caches_lock:
+        cache = _result_caches.get(session_key)
+        if cache is None:
+            cache = _result_caches[session_key] = ResultCache(global_settings.RESULT_CACHE_SIZE)
+    return cache
+
+def get_spool_key(settings, locale, corpus, query):
+    # Spools are shared between sessions. poliqarpd sorts according to the
+    # locale, and results change whenever the corpus is rebuilt:
+    return (
+        (corpus.id, corpus.get_version(), query, locale if settings.sort else None) +
+        tuple(getattr(settings, key) for key in SPOOL_KEY_SETTINGS)
+    )
+
+def get_result_cache_key(settings, language, corpus, query):
+    # Cached metadata is enhanced, i.e. translated:
+    return (corpus.id, query, language) + tuple(getattr(settings, key) for key in RESULT_CACHE_KEY_SETTINGS)
+
+def get_page_key(settings, corpus, query, l):
+    return (corpus.id, query, l) + tuple(getattr(settings, key) for key in PAGE_KEY_SETTINGS)
+
+def get_cached_page(request, key):
+    '''
+    Return a copy of the query info of the page last shown in this session,
+    or None if it had another key.
+    '''
+    page = request.session.get('page')
+    if page is None or page[0] != key:
+        return
+    return copy.copy(page[1])
+
+def cache_page(request, key, qinfo):
+    if isinstance(qinfo, Exception) or qinfo.running:
+        request.session.pop('page', None)
+    else:
+        page = copy.copy(qinfo)
+        page.results = rows.encode_results(qinfo.results)
+        request.session['page'] = (key, page)
+
+def prefetch_result_info(connection, corpus, cache, cache_key, l, raw_results, nth, base=0):
+    '''
+    Fetch wide contexts and metadata for the page of results (l being the
+    number of the first one) in a single pass, enhance the metadata in one
+    batch, and store them in the cache, so that moving to the other results
+    of the page doesn't need poliqarpd. Return the cached nth result.
+
+    base is the number of the first result in the poliqarpd buffer.
+    '''
+    if not 0 <= nth - l < len(raw_results):
         raise django.http.Http404
-    info = ResultInfo(n)
+    # The cache keeps at most RESULT_CACHE_SIZE results; fetch those around
+    # the nth one if the page is bigger:
+    size = min(len(raw_results), global_settings.RESULT_CACHE_SIZE)
+    start = min(max(nth - l - size // 2, 0), len(raw_results) - size)
+    ns = range(l + start, l + start + size)
+    contexts = [connection.get_context(n - base) for n in ns]
+    metadata = corpus.enhance_metadata_batch([connection.get_metadata(n - base, dict_type=list) for n in ns])
+    for i, n in enumerate(ns):
+        cached = CachedResult(raw_results[start + i], contexts[i], metadata[i], enhanced=True)
+        cache.put(cache_key, n, cached)
+        if n == nth:
+            result = cached
+    return result
+
+def fetch_result(connection, settings, corpus, query, cache, cache_key, nth, trace, timeout=None):
+    '''
+    Run the query in the poliqarpd session as far as the nth result, and
+    prefetch wide contexts and metadata of its page. Return the cached nth
+    result, or an exception.
+    '''
+    l = (nth // settings.results_per_page) * settings.results_per_page
+    r = l + settings.results_per_page - 1
+    # Results past the first poliqarpd buffer are linked to only from
+    # spooled pages, which are never sorted:
+    if nth >= global_settings.BUFFER_SIZE and not settings.sort:
+        qinfo = run_deep_query(connection, settings, corpus, query, nth, l, r, trace, timeout=timeout)
+        if isinstance(qinfo, Exception):
+            return qinfo
+        base, l, raw_results = qinfo
+    else:
+        qinfo = run_query(connection, settings, corpus, query, l, r, trace, timeout=timeout)
+        if isinstance(qinfo, Exception):
+            return qinfo
+        base, raw_results = 0, qinfo.results
+    with trace.stage('prefetch'):
+        return prefetch_result_info(connection, corpus, cache, cache_key, l, raw_results, nth, base)
+
+def cached_result_info(corpus, nth, cached, extract_context=True, extract_metadata=True):
+    info = ResultInfo(nth)
     if extract_context:
-        info.context = connection.get_context(n)
+        info.context = cached.context
     if extract_metadata:
-        info.metadata = connection.get_metadata(n, dict_type=corpus.enhance_metadata)
+        if cached.enhanced:
+            info.metadata = cached.metadata
+        else:
+            # Items of samples are kept in the session, where the language
+            # may change, so their metadata is enhanced when shown.
+            info.metadata = corpus.enhance_metadata(cached.metadata)
     return info
 
-def run_query(connection, settings, corpus, query, l, r):
-    connection.open_corpus(corpus.id)
-    try:
-        connection.make_query(query, force=settings.need_query_remake())
-    except poliqarp.InvalidQuery, ex:
-        return ex
-    except poliqarp.Busy, ex:
-        return ex
-    settings.need_query_remake(False)
-    qinfo = QueryInfo()
-    if settings.random_sample:
-        max_n_results = settings.random_sample_size
-    else:
-        max_n_results = global_settings.BUFFER_SIZE
-    del settings.random_sample_size
-    try:
-        connection.run_query(
-            max_n_results,
-            timeout=global_settings.QUERY_TIMEOUT,
-            force=settings.need_query_rerun()
-        )
-    except poliqarp.Busy, ex:
-        return ex
-    except poliqarp.QueryRunning, ex:
-        settings.need_query_rerun(False)
-        qinfo.running = True
-        if connection.get_n_stored_results() <= r or settings.sort or settings.random_sample:
-            # Need more results or query run to be finished
-            return ex
-    settings.need_query_rerun(False)
-    if settings.sort:
-        sort_column = dict(
-            lc=poliqarp.LeftContextType,
-            lm=poliqarp.LeftMatchType,
-            rm=poliqarp.RightMatchType,
-            rc=poliqarp.RightContextType,
-        )[settings.sort_column]
-        connection.sort(sort_column, settings.sort_type == 'atergo', settings.sort_direction == 'asc')
-    del settings.sort, settings.sort_column, settings.sort_atergo, settings.sort_ascending
-    settings.need_sort_rerun(False)
-    n_results = connection.get_n_stored_results()
+def paginate(qinfo, settings, page_url_template, l, r, n_results):
     l = max(l, 0)
     r = min(r, n_results - 1)
     if l > r > 0:
@@ -189,76 +379,639 @@ def run_query(connection, settings, corpus, query, l, r):
     if l > 0:
         page_size = min(l, settings.results_per_page)
         prev_l = l - page_size
-        qinfo.prev_page = PageInfo(corpus.id, page_start=prev_l, n=page_size)
+        qinfo.prev_page = PageInfo(page_url_template, page_start=prev_l, n=page_size)
     if n_results > r + 1:
         page_size = n_results - r - 1
         if page_size > settings.results_per_page or qinfo.running:
             page_size = settings.results_per_page
-        qinfo.next_page = PageInfo(corpus.id, page_start=r+1, n=page_size)
-    qinfo.results = connection.get_results(l, r)
+        qinfo.next_page = PageInfo(page_url_template, page_start=r+1, n=page_size)
+    return l, r
+
+def get_sort_args(settings):
+    '''
+    Return arguments of poliqarp.Connection.sort() for the settings dict.
+    '''
+    column = dict(
+        lc=poliqarp.LeftContextType,
+        lm=poliqarp.LeftMatchType,
+        rm=poliqarp.RightMatchType,
+        rc=poliqarp.RightContextType,
+    )[settings['sort_column']]
+    atergo = settings['sort_type'] == 'atergo'
+    ascending = settings['sort_direction'] == 'asc'
+    return column, atergo, ascending
+
+def run_query(connection, settings, corpus, query, l, r, trace, timeout=None):
+    if timeout is None:
+        timeout = global_settings.QUERY_TIMEOUT
+    with trace.stage('make_query'):
+        connection.open_corpus(corpus.id)
+        if connection.sampled_by is not None or is_scanned_past_first_buffer(connection):
+            # Scanning for a sample, a spool or a result past the first
+            # buffer has left the query past its first buffer.
+            settings.invalidate(REMAKE_QUERY)
+            connection.sampled_by = connection.scanned_to = None
+        if settings.need_query_remake() or settings.need_query_rerun():
+            connection.sorted_by = None
+        try:
+            connection.make_query(query, force=settings.need_query_remake())
+        except poliqarp.InvalidQuery, ex:
+            return ex
+        except poliqarp.Busy, ex:
+            return ex
+    settings.need_query_remake(False)
+    qinfo = QueryInfo()
+    max_n_results = global_settings.BUFFER_SIZE
+    with trace.stage('run_query'):
+        try:
+            connection.run_query(
+                max_n_results,
+                timeout=timeout,
+                force=settings.need_query_rerun()
+            )
+        except poliqarp.Busy, ex:
+            return ex
+        except poliqarp.QueryRunning, ex:
+            settings.need_query_rerun(False)
+            qinfo.running = True
+            if connection.get_n_stored_results() <= r or settings.sort:
+                # Need more results or query run to be finished
+                return ex
+    settings.need_query_rerun(False)
+    if settings.sort:
+        sort_column, sort_atergo, sort_ascending = get_sort_args(settings.get_dict())
+        sorted_by = (corpus.id, query, connection.get_n_stored_results(), sort_column, sort_atergo, sort_ascending)
+        # The results stay sorted until the query is run again:
+        if settings.need_sort_rerun() or connection.sorted_by != sorted_by:
+            with trace.stage('sort'):
+                connection.sort(sort_column, sort_atergo, sort_ascending)
+            connection.sorted_by = sorted_by
+    settings.need_sort_rerun(False)
+    n_results = connection.get_n_stored_results()
+    page_url_template = reverse_template(process_query, 'page_start', corpus_id=corpus.id)
+    l, r = paginate(qinfo, settings, page_url_template, l, r, n_results)
+    with trace.stage('get_results'):
+        qinfo.results = connection.get_results(l, r)
     qinfo.n_stored_results = connection.get_n_stored_results()
-    qinfo.n_spotted_results = connection.get_n_spotted_results()
-    if not settings.random_sample:
-        qinfo.n_spotted_results = None
-        if qinfo.n_stored_results == max_n_results:
-            # The query might be technically still running, but that's not
-            # very interesting from users' point of view.
-            qinfo.running = False
+    if qinfo.n_stored_results == max_n_results:
+        # The query might be technically still running, but that's not
+        # very interesting from users' point of view.
+        qinfo.running = False
+    return qinfo
+
+class ScanRunning(Exception):
+
+    '''
+    The query is still being run on to the poliqarpd buffer with the wanted
+    results; see seek_buffer().
+    '''
+
+def is_scanned_past_first_buffer(connection):
+    return connection.scanned_to is not None and connection.scanned_to[2:] != (0, False)
+
+def seek_buffer(connection, base, deadline):
+    '''
+    Run the query on, from where run_query() or an earlier call left it,
+    until the poliqarpd buffer holds results from base on (base being
+    a multiple of BUFFER_SIZE), or until the query ends. Return false if the
+    deadline (a time.time() value) passed first; the next call then carries
+    on from there.
+    '''
+    buffer_size = global_settings.BUFFER_SIZE
+    corpus_id, query, current, filling = connection.scanned_to
+    if not filling:
+        if current == base or connection.get_n_stored_results() < buffer_size:
+            return True
+        current += buffer_size
+    connection.sorted_by = None
+    for n_stored, running in connection.run_buffers(buffer_size, deadline=deadline, force=not filling):
+        connection.scanned_to = (corpus_id, query, current, running)
+        if not running:
+            if current == base or n_stored < buffer_size:
+                return True
+            current += buffer_size
+    return False
+
+def run_deep_query(connection, settings, corpus, query, nth, l, r, trace, timeout=None):
+    '''
+    Run the query on to the poliqarpd buffer which holds the nth result, past
+    the first buffer.
+
+    Return the number of the first result in the buffer, and number and list
+    of results from l to r which are in the buffer; or an exception.
+    '''
+    if timeout is None:
+        timeout = global_settings.QUERY_TIMEOUT
+    buffer_size = global_settings.BUFFER_SIZE
+    base = nth - nth % buffer_size
+    scanned_to = connection.scanned_to
+    if (
+        scanned_to is None or scanned_to[:2] != (corpus.id, query) or scanned_to[2] > base or
+        connection.sampled_by is not None or settings.need_query_remake() or settings.need_query_rerun()
+    ):
+        qinfo = run_query(connection, settings, corpus, query, buffer_size - 1, buffer_size - 1, trace, timeout=timeout)
+        if isinstance(qinfo, Exception):
+            return qinfo
+        connection.scanned_to = (corpus.id, query, 0, False)
+    with trace.stage('seek'):
+        if not seek_buffer(connection, base, time.time() + timeout):
+            return ScanRunning()
+    n_stored = connection.get_n_stored_results()
+    if connection.scanned_to[2] != base or nth - base >= n_stored:
+        raise django.http.Http404
+    l = max(l, base)
+    r = min(r, base + n_stored - 1)
+    with trace.stage('get_results'):
+        raw_results = connection.get_results(l - base, r - base)
+    return base, l, raw_results
+
+class Sample(object):
+
+    '''
+    Random sample of query results, drawn while scanning through all of
+    them, one poliqarpd buffer at a time.
+    '''
+
+    def __init__(self, key, size, seed):
+        self.key = key
+        self.size = size
+        self.seed = seed
+        self.restart()
+
+    def restart(self):
+        '''
+        Forget everything scanned so far.
+        '''
+        # Items are CachedResult objects; wide contexts and metadata are
+        # fetched only when asked for, see fetch_sample_items():
+        self.reservoir = utils.sampling.Reservoir(self.size, self.seed)
+        self.rows = rows.RowStore()
+        # Number of results scanned before the current buffer:
+        self.base = 0
+        # Whether the next run_query() needs to be forced, i.e. whether the
+        # query needs to be started or continued after a full buffer:
+        self.resume = True
+        self.started = False
+        self.done = False
+
+    @property
+    def scan_id(self):
+        return (self.key, self.seed)
+
+def get_sample_key(settings, corpus, query):
+    return (
+        corpus.id, query, settings.random_sample_size,
+        settings.left_context_width, settings.right_context_width, settings.wide_context_width,
+    )
+
+def get_sample(request, settings, corpus, query, seed=None, fresh=False):
+    key = get_sample_key(settings, corpus, query)
+    sample = request.session.get('sample')
+    if sample is not None and sample.key == key and not fresh and seed in (None, sample.seed):
+        return sample
+    if seed is None:
+        seed = random.randrange(1 << 31)
+    sample = Sample(key, settings.random_sample_size, seed)
+    request.session['sample'] = sample
+    return sample
+
+def feed_sample(connection, sample, n_stored):
+    '''
+    Add results from the current poliqarpd buffer to the sample.
+    '''
+    reservoir = sample.reservoir
+    base = sample.base
+    end = base + n_stored
+    while 1:
+        n = reservoir.next_wanted()
+        if n >= end:
+            break
+        if reservoir.filling():
+            # Consecutive results are wanted, fetch them in one go.
+            m = min(end, n + reservoir.size - len(reservoir))
+        else:
+            m = n + 1
+        for i, raw_result in enumerate(connection.get_results(n - base, m - 1 - base)):
+            reservoir.add(n + i, CachedResult(sample.rows.encode(raw_result), None, None))
+    reservoir.seen(end)
+    repack_cached_results(sample.rows, [item for (n, item) in reservoir.items()])
+
+def run_sample(connection, settings, corpus, query, sample):
+    if settings.need_query_rerun() or connection.sampled_by != sample.scan_id:
+        # The poliqarpd session has been created anew, or another query
+        # has been run in it, since the scan was started.
+        sample.restart()
+    settings.need_query_rerun(False)
+    connection.open_corpus(corpus.id)
+    try:
+        connection.make_query(query, force=not sample.started)
+    except poliqarp.InvalidQuery, ex:
+        return ex
+    except poliqarp.Busy, ex:
+        return ex
+    sample.started = True
+    connection.sampled_by = sample.scan_id
+    connection.sorted_by = connection.scanned_to = None
+    buffer_size = global_settings.BUFFER_SIZE
+    deadline = time.time() + global_settings.QUERY_TIMEOUT
+    try:
+        for n_stored, running in connection.run_buffers(buffer_size, deadline=deadline, force=sample.resume):
+            feed_sample(connection, sample, n_stored)
+            if running:
+                sample.resume = False
+            elif n_stored < buffer_size:
+                sample.resume = False
+                sample.done = True
+            else:
+                sample.base += n_stored
+                sample.resume = True
+    except poliqarp.Busy, ex:
+        return ex
+    return sample
+
+def get_sample_items(settings, sample):
+    '''
+    Return (n, item) pairs of the sample drawn so far, in the order chosen in
+    the settings.
+
+    poliqarpd sorts only the results in its own buffer, so the sample is
+    sorted here instead: by text of the column, lowercased (rather than by
+    collation rules of the locale).
+    '''
+    items = sample.reservoir.items()
+    if settings.sort:
+        column, atergo, ascending = get_sort_args(settings.get_dict())
+        def get_key(pair):
+            for ctype, segments in pair[1].raw_result:
+                if ctype == column:
+                    text = u' '.join(segment.orth for segment in segments).lower()
+                    break
+            else:
+                text = u''
+            if atergo:
+                text = text[::-1]
+            return text
+        items.sort(key=get_key, reverse=not ascending)
+    return items
+
+def get_sample_item(settings, sample, nth):
+    items = get_sample_items(settings, sample)
+    if nth >= len(items):
+        raise django.http.Http404
+    return items[nth][1]
+
+def fetch_sample_items(connection, settings, corpus, query, sample, nth):
+    '''
+    Fetch wide contexts and metadata of the items of a drawn sample which are
+    in the same poliqarpd buffer as its nth item. The query is scanned again
+    up to that buffer if needed, for at most QUERY_TIMEOUT seconds at a time;
+    the item is left alone if that is not enough.
+    '''
+    items = get_sample_items(settings, sample)
+    if nth >= len(items):
+        raise django.http.Http404
+    n, item = items[nth]
+    buffer_size = global_settings.BUFFER_SIZE
+    wanted_base = n - n % buffer_size
+    try:
+        connection.open_corpus(corpus.id)
+        if connection.sampled_by != sample.scan_id or wanted_base < sample.base:
+            connection.make_query(query, force=True)
+            connection.sampled_by = sample.scan_id
+            connection.sorted_by = connection.scanned_to = None
+            sample.base = 0
+            sample.resume = True
+        if sample.resume or sample.base < wanted_base or n - sample.base >= connection.get_n_stored_results():
+            deadline = time.time() + global_settings.QUERY_TIMEOUT
+            for n_stored, running in connection.run_buffers(buffer_size, deadline=deadline, force=sample.resume):
+                sample.resume = False
+                if sample.base == wanted_base:
+                    if n - sample.base < n_stored:
+                        break
+                elif not running:
+                    sample.base += n_stored
+                    sample.resume = True
+            else:
+                return
+    except poliqarp.Busy, ex:
+        return ex
+    end = sample.base + connection.get_n_stored_results()
+    for n, item in items:
+        if sample.base <= n < end and item.context is None:
+            item.context = connection.get_context(n - sample.base)
+            item.metadata = connection.get_metadata(n - sample.base, dict_type=list)
+
+def sample_query_info(settings, corpus, sample, l, r):
+    qinfo = QueryInfo()
+    qinfo.sample = True
+    qinfo.seed = sample.seed
+    qinfo.running = not sample.done
+    items = get_sample_items(settings, sample)
+    qinfo.n_stored_results = len(items)
+    qinfo.n_spotted_results = sample.reservoir.count
+    page_url_template = reverse_template(process_query, 'page_start', corpus_id=corpus.id)
+    l, r = paginate(qinfo, settings, page_url_template, l, r, len(items))
+    qinfo.results = [item.raw_result for (n, item) in items[l:r+1]]
+    return qinfo
+
+def spool_query_info(settings, corpus, spool, l, r):
+    qinfo = QueryInfo()
+    qinfo.n_stored_results = len(spool)
+    page_url_template = reverse_template(process_query, 'page_start', corpus_id=corpus.id)
+    l, r = paginate(qinfo, settings, page_url_template, l, r, len(spool))
+    qinfo.results = spool.get_results(l, r)
     return qinfo
 
-class Connection(poliqarp.Connection):
+def spool_results(connection, settings, corpus, query, spool_key, qinfo):
+    '''
+    Spool results of a query whose first poliqarpd buffer is complete, if
+    they don't fit on a single page and haven't been spooled yet.
 
-    def __init__(self, request):
-        poliqarp.Connection.__init__(self)
+    The query is run on, and spooled, a buffer at a time, up to
+    SPOOL_MAX_RESULTS results, for at most SPOOL_TIMEOUT seconds. Return
+    false if that was not enough.
+    '''
+    if global_settings.SPOOL_DIRECTORY is None:
+        return True
+    if qinfo.running or qinfo.n_stored_results <= settings.results_per_page:
+        return True
+    if spool.exists(spool_key):
+        return True
+    buffer_size = global_settings.BUFFER_SIZE
+    n_stored = qinfo.n_stored_results
+    if settings.sort or n_stored < buffer_size:
+        # poliqarpd sorts only the results in its buffer.
+        spool.write_spool(spool_key, connection.get_results(0, n_stored - 1))
+        return True
+    deadline = time.time() + global_settings.SPOOL_TIMEOUT
+    pending = spool.PendingSpool(spool_key)
+    try:
+        pending.append(connection.get_results(0, n_stored - 1))
+        n_spooled = n_stored
+        connection.scanned_to = (corpus.id, query, 0, False)
+        while n_stored == buffer_size and n_spooled < global_settings.SPOOL_MAX_RESULTS:
+            if not seek_buffer(connection, n_spooled, deadline):
+                pending.abort()
+                return False
+            n_stored = min(connection.get_n_stored_results(), global_settings.SPOOL_MAX_RESULTS - n_spooled)
+            if n_stored > 0:
+                pending.append(connection.get_results(0, n_stored - 1))
+            n_spooled += n_stored
+    except:
+        pending.abort()
+        raise
+    pending.commit()
+    return True
+
+def _memoizing(name):
+    '''
+    Wrap an argument-less query, so that poliqarpd is asked only once until
+    the state of the session changes.
+    '''
+    base = getattr(poliqarp.Connection, name)
+    def method(self):
+        if self._memo is None:
+            self._memo = {}
+        try:
+            return self._memo[name]
+        except KeyError:
+            result = self._memo[name] = base(self)
+            return result
+    method.__name__ = name
+    return method
+
+def _forgetting(name):
+    '''
+    Wrap a command which changes the state of the session.
+    '''
+    base = getattr(poliqarp.Connection, name)
+    def method(self, *args, **kwargs):
+        self._memo = None
+        return base(self, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+class BaseConnection(poliqarp.Connection):
+
+    '''
+    Connection to the poliqarpd which the session name is routed to.
+    Subclasses must implement get_default_session_name().
+
+    Answers to get_n_stored_results() and get_n_spotted_results() are
+    remembered until the next command that may change them, so that they
+    cost a single round trip per request, however many times they are asked
+    for. While a query is running in the background, this also means that
+    a request sees a consistent number of results.
+
+    Commands are not pipelined: the poliqarp binding owns the socket and
+    waits for the answer to each command, so every other command still
+    costs a round trip.
+    '''
+
+    def __init__(self):
+        backend = utils.routing.router.route(self.get_default_session_name())
+        if backend is None:
+            self.backend = None
+            self.connect()
+        else:
+            self.backend = backend.address
+            self.connect(host=backend.host, port=backend.port)
+
+    def connect(self, **kwargs):
+        poliqarp.Connection.__init__(self, **kwargs)
+
+    # Address of the poliqarpd, or None for the default one:
+    backend = None
+
+    # Settings of the poliqarpd session, as last sent by sync_settings():
+    backend_settings = None
+
+    # Query and order of results in the poliqarpd buffer, as last sorted by
+    # run_query():
+    sorted_by = None
+
+    # Sample.scan_id of the sample whose query was last made by
+    # run_sample() or fetch_sample_items(), if no other query was made since:
+    sampled_by = None
+
+    # (corpus id, query, number of the first result in the poliqarpd buffer,
+    # whether the buffer is still being filled), as left by seek_buffer():
+    scanned_to = None
+
+    # Remembered answers, see _memoizing():
+    _memo = None
+
+    get_n_stored_results = _memoizing('get_n_stored_results')
+    get_n_spotted_results = _memoizing('get_n_spotted_results')
+
+    make_session = _forgetting('make_session')
+    resize_buffer = _forgetting('resize_buffer')
+    open_corpus = _forgetting('open_corpus')
+    make_query = _forgetting('make_query')
+    run_query = _forgetting('run_query')
+    sort = _forgetting('sort')
+    # Nothing remembered may outlive the request:
+    close = _forgetting('close')
+
+    def run_buffers(self, buffer_size, timeout=None, deadline=None, force=True):
+        '''
+        Run the query through consecutive buffers of buffer_size results.
+
+        After each run_query() call, yield the number of stored results and
+        whether the buffer is still being filled, which happens if the call
+        took longer than timeout seconds; the next call then waits for the
+        same buffer. Stop when the query is finished or, after a call, once
+        the deadline (a time.time() value) has passed. The first call is
+        forced only if force is true.
+        '''
+        # poliqarpd continues a query, which has filled the buffer, from
+        # where it stopped; only make_query() rewinds it.
+        while 1:
+            call_timeout = timeout
+            if deadline is not None:
+                call_timeout = max(deadline - time.time(), 0)
+                if timeout is not None:
+                    call_timeout = min(call_timeout, timeout)
+            running = False
+            try:
+                self.run_query(buffer_size, timeout=call_timeout, force=force)
+            except poliqarp.QueryRunning:
+                running = True
+            n_stored = self.get_n_stored_results()
+            yield n_stored, running
+            if not running and n_stored < buffer_size:
+                return
+            if deadline is not None and time.time() >= deadline:
+                return
+            force = not running
+
+class Connection(BaseConnection):
+
+    def __init__(self, request, suffix=None):
         self.__session_name = '%s/%s' % (request.META.get('REMOTE_ADDR'), request.session.session_key)
+        if suffix is not None:
+            self.__session_name += '/%s' % suffix
+        BaseConnection.__init__(self)
 
     def get_default_session_name(self):
         return self.__session_name
 
-def setup_settings(request, settings, connection):
-    del settings.results_per_page # Never need to be dirty
+def get_backend_settings(locale, settings):
+    return dict(
+        notification_interval=(global_settings.NOTIFICATION_INTERVAL,),
+        locale=(locale,),
+        retrieve_ids=(0, 1, 1, 0),
+        # These settings are ignored at retrieve level:
+        retrieve_lemmata=(1, 1, 1, 1),
+        retrieve_tags=(1, 1, 1, 1),
+        left_context_width=(settings['left_context_width'],),
+        right_context_width=(settings['right_context_width'],),
+        wide_context_width=(settings['wide_context_width'],),
+        # Random samples are drawn by marasca itself, see run_sample():
+        random_sample=(0,),
+    )
+
+def sync_settings(locale, settings, connection, calls=()):
+    '''
+    Send to poliqarpd only these settings that differ from what the session
+    has already got, after the extra (method name, arguments) calls. Return
+    names of the changed settings.
+
+    Reset connection.backend_settings whenever a new session is made.
+    '''
+    wanted = get_backend_settings(locale, settings)
+    current = connection.backend_settings or {}
+    changed = sorted(name for name, args in wanted.iteritems() if current.get(name) != args)
+    calls = list(calls) + [('set_%s' % name, wanted[name]) for name in changed]
+    for name, args in calls:
+        getattr(connection, name)(*args)
+    connection.backend_settings = wanted
+    return changed
+
+def get_new_session_calls(buffer_size=None):
+    '''
+    Return calls which prepare a newly made poliqarpd session.
+    '''
+    if buffer_size is None:
+        buffer_size = global_settings.BUFFER_SIZE
+    return [('resize_buffer', (buffer_size,))]
+
+def setup_settings(request, settings, connection, calls=()):
     locale = utils.i18n.get_locale(request.LANGUAGE_CODE)
-    connection.set_notification_interval(global_settings.NOTIFICATION_INTERVAL)
-    connection.set_locale(locale)
-    del settings.language
-    connection.set_retrieve_ids(0, 1, 1, 0)
-    # These settings are ignored at retrieve level:
-    connection.set_retrieve_lemmata(1, 1, 1, 1)
-    connection.set_retrieve_tags(1, 1, 1, 1)
-    del settings.show_in_context
-    del settings.show_in_match
-    connection.set_left_context_width(settings.left_context_width)
-    connection.set_right_context_width(settings.right_context_width)
-    connection.set_wide_context_width(settings.wide_context_width)
-    del settings.left_context_width
-    del settings.right_context_width
-    del settings.wide_context_width
-    connection.set_random_sample(settings.random_sample)
-    del settings.random_sample
+    sync_settings(locale, settings.get_dict(), connection, calls)
+
+class ColumnFlags(object):
+
+    '''
+    Which parts of interpretations are displayed in match and context
+    columns, as chosen in the settings of a request.
+    '''
+
+    def __init__(self, settings):
+        self.match = ('l' in settings.show_in_match, 't' in settings.show_in_match)
+        self.context = ('l' in settings.show_in_context, 't' in settings.show_in_context)
+
+class Column(tuple):
+
+    '''
+    (column type, segments) pair, which also tells which parts of
+    interpretations are displayed.
+    '''
+
+    def __new__(cls, column, show_lemmata, show_tags):
+        self = tuple.__new__(cls, column)
+        self.show_lemmata = show_lemmata
+        self.show_tags = show_tags
+        return self
 
 class Result(object):
 
-    def __init__(self, corpus, n, raw_result, settings):
-        self._raw_result = list(raw_result)
+    '''
+    Query result, which looks like a list of Column pairs.
+    '''
+
+    __slots__ = ('n', '_raw_result', '_url_template', '_flags')
+
+    def __init__(self, n, raw_result, url_template, flags):
         self.n = n
-        self.url = django.core.urlresolvers.reverse(
-            process_query,
-            kwargs=dict(corpus_id=corpus.id, nth=n)
-        )
-        for column in self._raw_result:
-            ctype = column[0]
-            if ctype.is_match:
-                ctype.show_lemmata = 'l' in settings.show_in_match
-                ctype.show_tags = 't' in settings.show_in_match
-            elif ctype.is_context:
-                ctype.show_lemmata = 'l' in settings.show_in_context
-                ctype.show_tags = 't' in settings.show_in_context
+        self._raw_result = raw_result
+        self._url_template = url_template
+        self._flags = flags
+
+    def _get_raw_result(self):
+        raw_result = self._raw_result
+        if isinstance(raw_result, rows.CompactResult):
+            # Decoded once per request; the compact result itself stays
+            # compact.
+            raw_result = self._raw_result = raw_result.decode()
+        return raw_result
+
+    @property
+    def url(self):
+        return self._url_template % self.n
+
+    def _column(self, column):
+        if column[0].is_match:
+            show_lemmata, show_tags = self._flags.match
+        else:
+            show_lemmata, show_tags = self._flags.context
+        return Column(column, show_lemmata, show_tags)
 
     def __getitem__(self, n):
-        return self._raw_result[n]
+        return self._column(self._get_raw_result()[n])
 
     def __iter__(self):
-        return iter(self._raw_result)
+        for column in self._get_raw_result():
+            yield self._column(column)
+
+    def __len__(self):
+        return len(self._raw_result)
+
+def make_results(corpus, l, raw_results, settings, url_template=None):
+    if url_template is None:
+        url_template = reverse_template(process_query, 'nth', corpus_id=corpus.id)
+    flags = ColumnFlags(settings)
+    return [Result(l + i, raw_result, url_template, flags) for (i, raw_result) in enumerate(raw_results)]
 
 def enhance_columns(results, settings):
     for result in results:
@@ -281,20 +1034,35 @@ def report_invalid_session_id(request, exc_info):
     message = "%s\n\n%s" % (get_traceback(exc_info), request_repr)
     django.core.mail.mail_admins(subject, message)
 
+def new_connection(request, settings):
+    connection = Connection(request)
+    request.session['connection'] = connection
+    connection.make_session()
+    setup_settings(request, settings, connection, get_new_session_calls())
+    settings.invalidate(RERUN_QUERY)
+    return connection
+
 @contextlib.contextmanager
-def connection_for(request, settings):
-    with utils.locks.SessionLock(request.session):
+def connection_for(request, settings, wait=None):
+    with utils.locks.SessionLock(request.session, wait=wait):
         connection = request.session.get('connection')
+        if connection is not None and connection.backend is not None:
+            if not utils.routing.router.is_healthy(connection.backend):
+                # Fail over to another backend; the session will be
+                # created there from scratch.
+                connection.close()
+                connection = None
         if connection is None:
             connection = Connection(request)
             request.session['connection'] = connection
         try:
             try:
                 if connection.make_session():
-                    connection.resize_buffer(global_settings.BUFFER_SIZE)
-                    setup_settings(request, settings, connection)
-                    settings.need_query_rerun(True)
-                elif settings.dirty():
+                    connection.backend_settings = connection.sorted_by = connection.sampled_by = connection.scanned_to = None
+                    setup_settings(request, settings, connection, get_new_session_calls())
+                    settings.invalidate(RERUN_QUERY)
+                else:
+                    # Cheap if nothing has changed:
                     setup_settings(request, settings, connection)
             except (poliqarp.errors.InvalidSessionId, poliqarp.errors.InvalidSessionUserId):
                 # Forget about this connection
@@ -303,12 +1071,13 @@ def connection_for(request, settings):
                 connection.close()
                 report_invalid_session_id(request, sys.exc_info())
                 # Create a new one
-                connection = Connection(request)
-                request.session['connection'] = connection
-                connection.make_session()
-                connection.resize_buffer(global_settings.BUFFER_SIZE)
-                setup_settings(request, settings, connection)
-                settings.need_query_rerun(True)
+                connection = new_connection(request, settings)
+            except socket.error:
+                if connection.backend is None:
+                    raise
+                utils.routing.router.mark_down(connection.backend)
+                connection.close()
+                connection = new_connection(request, settings)
             yield connection
             connection.suspend_session()
         finally:
@@ -320,7 +1089,11 @@ def corpus_info(request, corpus_id):
     form = QueryForm()
     request.session.set_test_cookie()
     corpus = get_corpus_by_id(corpus_id)
-    context = Context(request, selected=corpus, form=form)
+    statistics = corpus_statistics.load(corpus)
+    top_tags = None
+    if statistics is not None:
+        top_tags = statistics.top_tags(global_settings.CORPUS_STATISTICS_TOP_TAGS)
+    context = Context(request, selected=corpus, form=form, statistics=statistics, top_tags=top_tags)
     try:
         extra_template = django.template.loader.get_template('corpora/%s.html' % corpus.id)
         corpus_info = extra_template.render(context)
@@ -337,8 +1110,72 @@ def temporary_overload(request):
     response['Retry-After'] = 60
     return response
 
+def query_sample(request, settings, corpus, query, l, r, nth):
+    try:
+        seed = int(request.GET['seed'])
+    except (KeyError, ValueError):
+        seed = None
+    # With random sample on, rerunning query makes sense
+    # even if query text didn't change.
+    sample = get_sample(request, settings, corpus, query, seed=seed, fresh=(request.method == 'POST'))
+    if not sample.done or (nth is not None and get_sample_item(settings, sample, nth).context is None):
+        try:
+            with connection_for(request, settings, wait=global_settings.QUERY_SESSION_LOCK_TIMEOUT) as connection:
+                result = None
+                if not sample.done:
+                    result = run_sample(connection, settings, corpus, query, sample)
+                if sample.done and nth is not None and not isinstance(result, Exception):
+                    result = fetch_sample_items(connection, settings, corpus, query, sample, nth)
+        except utils.locks.SessionLocked, ex:
+            return ex
+        if isinstance(result, Exception):
+            return result
+    qinfo = sample_query_info(settings, corpus, sample, l, r)
+    qinfo.share_url = '%s?%s' % (
+        django.core.urlresolvers.reverse(process_query, kwargs=dict(corpus_id=corpus.id)),
+        urllib.urlencode(dict(query=query.encode('UTF-8'), seed=sample.seed, size=sample.size))
+    )
+    if nth is not None:
+        cached = get_sample_item(settings, sample, nth)
+        if cached.context is None:
+            qinfo.rinfo = ResultInfo(nth)
+            qinfo.fetching = True
+        else:
+            qinfo.rinfo = cached_result_info(corpus, nth, cached)
+    return qinfo
+
+def apply_shared_sample(request, settings):
+    '''
+    Switch sampling on, with the sample size given in a shared sample link.
+    '''
+    settings.random_sample = True
+    try:
+        settings.random_sample_size = SettingsForm.base_fields['random_sample_size'].clean(request.GET.get('size'))
+    except django.forms.ValidationError:
+        # Links shared before the size was added to them.
+        pass
+    request.session.modified = True
+
+def stream_query_results(request, corpus, qinfo, head, tail, trace):
+    # This is run after the view has returned, so the request is recorded in
+    # the slow query log only once all of it has been sent:
+    try:
+        yield head
+        django.utils.translation.activate(request.LANGUAGE_CODE)
+        template = get_template('query-rows.html')
+        size = global_settings.STREAM_CHUNK_SIZE
+        for i in xrange(0, len(qinfo.results), size):
+            context = django.template.Context(dict(selected=corpus, qinfo=qinfo, rows=qinfo.results[i:i+size]))
+            with trace.stage('render_rows'):
+                chunk = template.render(context)
+            yield chunk
+        yield tail
+    finally:
+        slowlog.record(trace)
+
 @django.views.decorators.cache.never_cache
 def process_query(request, corpus_id, query=False, page_start=0, nth=None):
+    trace = slowlog.get_trace(request)
     settings = get_settings(request)
     template = get_template('query.html')
     corpus = get_corpus_by_id(corpus_id)
@@ -358,7 +1195,7 @@ def process_query(request, corpus_id, query=False, page_start=0, nth=None):
         if not request.session.test_cookie_worked():
             error = ugettext_lazy('Please enable cookies and try again')
     elif query:
-        query = request.session.get('query')
+        query = request.GET.get('query') or request.session.get('query')
         if query is not None:
             form_data = dict(query=query)
     form = QueryForm(form_data)
@@ -366,38 +1203,165 @@ def process_query(request, corpus_id, query=False, page_start=0, nth=None):
     if form_data is not None and form.is_valid() and error is None:
         query = form.cleaned_data['query']
         request.session['query'] = query
+        trace.corpus_id = corpus.id
+        trace.query = query
+        trace.settings = settings.get_dict()
         if nth is not None:
             nth = int(nth)
             l = (nth // settings.results_per_page) * settings.results_per_page
         else:
             l = int(page_start or 0)
         r = l + settings.results_per_page - 1
-        with connection_for(request, settings) as connection:
-            if request.method == 'POST' and settings.random_sample:
-                # With random sample on, rerunning query makes sense
-                # even if query text didn't change
-                settings.need_query_remake(True)
-            try:
-                qinfo = run_query(connection, settings, corpus, query, l, r)
-            except poliqarp.Busy:
-                return temporary_overload(request)
-            if not isinstance(qinfo, Exception) and nth is not None:
-                qinfo.rinfo = extract_result_info(connection, settings, corpus, nth)
-        if isinstance(qinfo, (poliqarp.Busy, poliqarp.QueryRunning)):
+        if 'seed' in request.GET:
+            apply_shared_sample(request, settings)
+        if settings.random_sample:
+            trace.outcome = 'sample'
+            with trace.stage('sample'):
+                qinfo = query_sample(request, settings, corpus, query, l, r, nth)
+        else:
+            cache = get_result_cache(request)
+            cache_key = get_result_cache_key(settings, request.LANGUAGE_CODE, corpus, query)
+            page_key = get_page_key(settings, corpus, query, l)
+            spool_key = get_spool_key(settings, utils.i18n.get_locale(request.LANGUAGE_CODE), corpus, query)
+            stale = (
+                request.method == 'POST' or
+                settings.need_query_remake() or settings.need_query_rerun() or settings.need_sort_rerun()
+            )
+            if stale:
+                cache.clear()
+                request.session.pop('page', None)
+            cached = page = result_spool = None
+            if nth is not None:
+                cached = cache.get(cache_key, nth)
+            else:
+                page = get_cached_page(request, page_key)
+                if page is None and not stale and global_settings.SPOOL_DIRECTORY is not None:
+                    # A stale query is run in poliqarpd, even if it has been
+                    # spooled, so that the session catches up with it.
+                    result_spool = spool.open_spool(spool_key)
+            if cached is not None:
+                trace.outcome = 'cache'
+                qinfo = QueryInfo()
+                qinfo.results = [cached.raw_result]
+                qinfo.rinfo = cached_result_info(corpus, nth, cached)
+                l = nth
+            elif page is not None:
+                # Only the way the page is rendered has changed since it was
+                # last shown.
+                trace.outcome = 'page'
+                qinfo = page
+            elif result_spool is not None:
+                # Results of this query have been spooled, maybe in another
+                # session; poliqarpd is not needed at all.
+                trace.outcome = 'spool'
+                with trace.stage('spool'):
+                    qinfo = spool_query_info(settings, corpus, result_spool, l, r)
+                result_spool.close()
+            else:
+                trace.outcome = 'poliqarpd'
+                # Polls from the pending page don't wait for the query;
+                # the browser does the waiting instead of the worker.
+                running_key = (corpus.id, query)
+                if request.method != 'POST' and request.session.get('running_query') == running_key:
+                    timeout = global_settings.PENDING_QUERY_TIMEOUT
+                else:
+                    timeout = global_settings.QUERY_TIMEOUT
+                t = time.time()
+                try:
+                    with connection_for(request, settings, wait=global_settings.QUERY_SESSION_LOCK_TIMEOUT) as connection:
+                        trace.add('connect', time.time() - t)
+                        try:
+                            if nth is not None:
+                                cached = fetch_result(connection, settings, corpus, query, cache, cache_key, nth, trace, timeout=timeout)
+                                if isinstance(cached, Exception):
+                                    qinfo = cached
+                                else:
+                                    qinfo = QueryInfo()
+                                    qinfo.results = [cached.raw_result]
+                                    qinfo.rinfo = cached_result_info(corpus, nth, cached)
+                                    l = nth
+                            else:
+                                qinfo = run_query(connection, settings, corpus, query, l, r, trace, timeout=timeout)
+                        except poliqarp.Busy:
+                            trace.outcome = 'overload'
+                            return temporary_overload(request)
+                        if isinstance(qinfo, (poliqarp.QueryRunning, ScanRunning)):
+                            request.session['running_query'] = running_key
+                        else:
+                            request.session.pop('running_query', None)
+                        if nth is None:
+                            cache_page(request, page_key, qinfo)
+                            if not isinstance(qinfo, Exception) and request.session.get('unspooled') != spool_key:
+                                with trace.stage('write_spool'):
+                                    if not spool_results(connection, settings, corpus, query, spool_key, qinfo):
+                                        # Don't make this session wait for
+                                        # it again.
+                                        request.session['unspooled'] = spool_key
+                except utils.locks.SessionLocked, ex:
+                    # Another request of this session is talking to
+                    # poliqarpd; wait in the browser rather than here.
+                    qinfo = ex
+        if isinstance(qinfo, Exception):
+            trace.outcome = type(qinfo).__name__
+        if isinstance(qinfo, (poliqarp.Busy, poliqarp.QueryRunning, ScanRunning, utils.locks.SessionLocked)):
             return redirect_to_pending(request)
         if isinstance(qinfo, Exception):
             error = qinfo
             qinfo = None
         else:
-            qinfo.results = [Result(corpus, l + i, result, settings) for (i, result) in enumerate(qinfo.results)]
+            qinfo.results = make_results(corpus, l, qinfo.results, settings)
             if nth is not None:
                 qinfo.result = qinfo.results[qinfo.rinfo.n - l]
             corpus.enhance_results(qinfo.results)
+            n_results = qinfo.n_stored_results
+            if not (qinfo.sample or qinfo.running) and n_results is not None and n_results < global_settings.BUFFER_SIZE:
+                # All the results are known, so their number is exact.
+                statistics = corpus_statistics.load(corpus)
+                if statistics is not None:
+                    qinfo.relative_frequency = statistics.relative_frequency(n_results)
     if error is not None:
         form._errors.setdefault('query', form.error_class()).append(error)
-    context = Context(request, selected=corpus, form=form, qinfo=qinfo)
-    response = django.http.HttpResponse(template.render(context))
-    response['Refresh'] = str(global_settings.SESSION_REFRESH)
+    # Large tables are sent a chunk of rows at a time, after the rest of the
+    # page:
+    stream = (
+        qinfo is not None and nth is None and
+        len(qinfo.results) >= global_settings.STREAM_RESULTS_THRESHOLD
+    )
+    context = Context(request, selected=corpus, form=form, qinfo=qinfo, job_form=JobForm(),
+        keepalive_interval=global_settings.SESSION_REFRESH * 1000,
+        rows_marker=(_stream_marker if stream else None))
+    with trace.stage('render'):
+        content = template.render(context)
+    if stream:
+        head, tail = content.split(_stream_marker)
+        trace.deferred = True
+        response = streaming_response(request, stream_query_results(request, corpus, qinfo, head, tail, trace))
+    else:
+        response = django.http.HttpResponse(content)
+    if qinfo is not None and qinfo.sample and (qinfo.running or qinfo.fetching):
+        # Show the sample drawn so far, then continue scanning (or looking
+        # for the shown item).
+        response['Refresh'] = '1'
+    return response
+
+@django.views.decorators.cache.never_cache
+def process_keepalive(request):
+    '''
+    Touch the poliqarpd session, so that it doesn't reach its idle limit
+    while the user is looking at query results.
+    '''
+    response = django.http.HttpResponse(status=204)
+    if request.session.get('connection') is None:
+        return response
+    settings = get_settings(request)
+    try:
+        with connection_for(request, settings, wait=0) as connection:
+            connection.ping()
+    except utils.locks.SessionLocked:
+        # The session is in use anyway.
+        pass
+    except poliqarp.Busy:
+        pass
     return response
 
 @django.views.decorators.cache.never_cache
@@ -406,11 +1370,559 @@ def process_metadata_snippet(request, corpus_id, nth):
     template = get_template('result-metadata.html')
     corpus = get_corpus_by_id(corpus_id)
     nth = int(nth)
-    with connection_for(request, settings) as connection:
-        rinfo = extract_result_info(connection, settings, corpus, nth)
+    query = request.session.get('query')
+    cached = None
+    retry_soon = django.http.HttpResponse(status=503)
+    retry_soon['Retry-After'] = 1
+    if query is not None and settings.random_sample:
+        sample = request.session.get('sample')
+        if sample is None or sample.key != get_sample_key(settings, corpus, query):
+            raise django.http.Http404
+        if not sample.done:
+            return retry_soon
+        cached = get_sample_item(settings, sample, nth)
+        if cached.metadata is None:
+            try:
+                with connection_for(request, settings, wait=global_settings.QUERY_SESSION_LOCK_TIMEOUT) as connection:
+                    fetch_sample_items(connection, settings, corpus, query, sample, nth)
+            except utils.locks.SessionLocked:
+                return retry_soon
+            if cached.metadata is None:
+                return retry_soon
+    elif query is not None:
+        cache = get_result_cache(request)
+        cache_key = get_result_cache_key(settings, request.LANGUAGE_CODE, corpus, query)
+        cached = cache.get(cache_key, nth)
+        if cached is None:
+            # The page may have been served from a spool, or the cache
+            # by another process, so the poliqarpd session may hold
+            # results of another query.
+            try:
+                with connection_for(request, settings, wait=global_settings.QUERY_SESSION_LOCK_TIMEOUT) as connection:
+                    cached = fetch_result(connection, settings, corpus, query, cache, cache_key, nth, slowlog.get_trace(request))
+            except (utils.locks.SessionLocked, poliqarp.Busy):
+                return retry_soon
+            if isinstance(cached, poliqarp.InvalidQuery):
+                raise django.http.Http404
+            if isinstance(cached, Exception):
+                return retry_soon
+    if cached is None:
+        raise django.http.Http404
+    rinfo = cached_result_info(corpus, nth, cached, extract_context=False)
     context = Context(request, qinfo=dict(rinfo=rinfo))
     return django.http.HttpResponse(template.render(context))
 
+class MultiQueryForm(django.forms.Form):
+    query = django.forms.CharField(max_length=1000, label=ugettext_lazy('Query'))
+    corpora = django.forms.MultipleChoiceField(
+        label=ugettext_lazy('Corpora'),
+        widget=django.forms.CheckboxSelectMultiple,
+    )
+
+    def clean_query(self):
+        return clean_query(self.cleaned_data['query'])
+
+    def __init__(self, *args, **kwargs):
+        django.forms.Form.__init__(self, *args, **kwargs)
+        self.fields['corpora'].choices = [
+            (corpus.id, ugettext_lazy(corpus.title))
+            for corpus in global_settings.CORPORA
+            if corpus.public
+        ]
+
+class CorpusConnections(object):
+
+    '''
+    Connections to separate poliqarpd sessions, one per corpus, so that a
+    query can run in several corpora at the same time.
+    '''
+
+    def __init__(self):
+        self._connections = {}
+        self._serial = 0
+
+    def get(self, request, corpus_id):
+        connection = self._connections.get(corpus_id)
+        if connection is not None and connection.backend is not None:
+            if not utils.routing.router.is_healthy(connection.backend):
+                connection = None
+        if connection is None:
+            self._serial += 1
+            connection = Connection(request, suffix='%s/%d' % (corpus_id, self._serial))
+            self._connections[corpus_id] = connection
+        return connection
+
+    def discard(self, corpus_id):
+        self._connections.pop(corpus_id, None)
+
+def get_corpus_connections(request):
+    connections = request.session.get('corpus_connections')
+    if connections is None:
+        connections = CorpusConnections()
+        request.session['corpus_connections'] = connections
+    return connections
+
+class CorpusQueryInfo(QueryInfo):
+
+    def __init__(self, corpus):
+        QueryInfo.__init__(self)
+        self.corpus = corpus
+        self.error = None
+        self.timed_out = False
+
+def query_corpus(connection, locale, settings, corpus, query, n):
+    '''
+    Run the query in a single corpus and fetch first n results.
+
+    Only the connection is touched, so this can be run in a separate thread.
+    '''
+    qinfo = CorpusQueryInfo(corpus)
+    try:
+        try:
+            calls = ()
+            if connection.make_session():
+                connection.backend_settings = None
+                calls = get_new_session_calls()
+            sync_settings(locale, settings, connection, calls)
+            # Context widths are applied when results are fetched, so only a
+            # new session needs the query to be run again:
+            force = bool(calls)
+            connection.open_corpus(corpus.id)
+            connection.make_query(query, force=force)
+            try:
+                connection.run_query(
+                    global_settings.BUFFER_SIZE,
+                    timeout=global_settings.MULTI_QUERY_TIMEOUT,
+                    force=force
+                )
+            except poliqarp.QueryRunning:
+                qinfo.running = True
+            qinfo.n_stored_results = connection.get_n_stored_results()
+            if qinfo.n_stored_results > 0:
+                qinfo.l = 1
+                qinfo.r = min(n, qinfo.n_stored_results)
+                qinfo.results = connection.get_results(0, qinfo.r - 1)
+            if qinfo.n_stored_results == global_settings.BUFFER_SIZE:
+                qinfo.running = False
+            connection.suspend_session()
+        except (poliqarp.InvalidQuery, poliqarp.Busy), ex:
+            qinfo.error = ex
+    finally:
+        connection.close()
+    return qinfo
+
+def query_corpora(request, settings, corpora, query):
+    '''
+    Run the query in several corpora at the same time, each over its own
+    connection. Yield per-corpus results as soon as they are available.
+    '''
+    connections = get_corpus_connections(request)
+    locale = utils.i18n.get_locale(request.LANGUAGE_CODE)
+    settings_dict = settings.get_dict()
+    queue = Queue.Queue()
+    def run(connection, corpus):
+        queue.put(query_corpus(connection, locale, settings_dict, corpus, query, settings.results_per_page))
+    pending = {}
+    for corpus in corpora:
+        connection = connections.get(request, corpus.id)
+        thread = threading.Thread(target=run, args=(connection, corpus))
+        thread.setDaemon(True)
+        thread.start()
+        pending[corpus.id] = corpus
+    # run_query() gives up after MULTI_QUERY_TIMEOUT, the rest of this
+    # deadline is for connecting to poliqarpd and fetching results:
+    deadline = time.time() + 2 * global_settings.MULTI_QUERY_TIMEOUT
+    while pending:
+        try:
+            qinfo = queue.get(timeout=max(deadline - time.time(), 0))
+        except Queue.Empty:
+            break
+        del pending[qinfo.corpus.id]
+        yield qinfo
+    for corpus in pending.itervalues():
+        # The connection is still in use by its thread, don't reuse it:
+        connections.discard(corpus.id)
+        qinfo = CorpusQueryInfo(corpus)
+        qinfo.timed_out = True
+        yield qinfo
+
+_stream_marker = '<!-- results -->'
+
+def accepts_gzip(request):
+    return 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+
+def gzip_stream(chunks):
+    '''
+    Compress chunks on the fly. Every chunk is flushed, so that the browser
+    can show it before the next one is ready.
+    '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('UTF-8')
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def streaming_response(request, content, lock=None):
+    '''
+    Return a response which sends the content chunk by chunk. If a session
+    lock is given, it must be already acquired; it is released once the
+    response has been sent.
+    '''
+    try:
+        response_type = django.http.StreamingHttpResponse
+    except AttributeError:
+        # Django < 1.5
+        response_type = django.http.HttpResponse
+    gzip = global_settings.STREAM_GZIP and accepts_gzip(request)
+    if gzip:
+        content = gzip_stream(content)
+    if lock is not None:
+        content = utils.locks.LockedIterator(lock, content)
+    response = response_type(content)
+    if gzip:
+        response['Content-Encoding'] = 'gzip'
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+def stream_multi_query(request, settings, corpora, query, head, tail):
+    yield head
+    # This is run after the view has returned, so the session has been
+    # already saved, and the language might have been deactivated:
+    django.utils.translation.activate(request.LANGUAGE_CODE)
+    template = get_template('multi-query-corpus.html')
+    # The session lock is held by the response, see process_multi_query():
+    for qinfo in query_corpora(request, settings, corpora, query):
+        qinfo.results = make_results(qinfo.corpus, 0, qinfo.results, settings)
+        qinfo.corpus.enhance_results(qinfo.results)
+        yield template.render(Context(request, qinfo=qinfo))
+    request.session.save()
+    yield tail
+
+def lock_session(request):
+    '''
+    Acquire the session lock for a streamed response, or return None if
+    another request of this session holds it.
+    '''
+    lock = utils.locks.SessionLock(request.session, wait=global_settings.QUERY_SESSION_LOCK_TIMEOUT)
+    try:
+        lock.acquire()
+    except utils.locks.SessionLocked:
+        return
+    return lock
+
+@django.views.decorators.cache.never_cache
+def process_multi_query(request):
+    settings = get_settings(request)
+    template = get_template('multi-query.html')
+    error = None
+    form_data = None
+    if request.method == 'POST':
+        form_data = request.POST
+        if not request.session.test_cookie_worked():
+            error = ugettext_lazy('Please enable cookies and try again')
+    form = MultiQueryForm(form_data)
+    request.session.set_test_cookie()
+    if form_data is None or not form.is_valid() or error is not None:
+        if error is not None:
+            form._errors.setdefault('query', form.error_class()).append(error)
+        context = Context(request, selected='multi-query', form=form)
+        return django.http.HttpResponse(template.render(context))
+    query = form.cleaned_data['query']
+    corpora = [get_corpus_by_id(corpus_id) for corpus_id in form.cleaned_data['corpora']]
+    # Links to individual results are resolved using the session query:
+    request.session['query'] = query
+    # Connections are taken from the session, so take the session lock
+    # before the response is started rather than while it is being sent:
+    lock = lock_session(request)
+    if lock is None:
+        return temporary_overload(request)
+    context = Context(request, selected='multi-query', form=form, stream_marker=_stream_marker)
+    head, tail = template.render(context).split(_stream_marker)
+    content = stream_multi_query(request, settings, corpora, query, head, tail)
+    return streaming_response(request, content, lock=lock)
+
+class CountForm(django.forms.Form):
+    queries = django.forms.FileField(
+        label=ugettext_lazy('Queries'),
+        help_text=ugettext_lazy('A text file with one query per line.'),
+    )
+
+    def clean_queries(self):
+        file = self.cleaned_data['queries']
+        # Queries are at most 1000 characters long, see QueryForm:
+        if file.size > global_settings.MAX_COUNT_QUERIES * 1000 * 4:
+            raise django.forms.ValidationError(ugettext_lazy('The file is too large.'))
+        try:
+            text = file.read().decode('UTF-8')
+        except UnicodeDecodeError:
+            raise django.forms.ValidationError(ugettext_lazy('The file must be encoded in UTF-8.'))
+        queries = [line.strip() for line in text.splitlines()]
+        queries = [query for query in queries if query]
+        if not queries:
+            raise django.forms.ValidationError(ugettext_lazy('The file contains no queries.'))
+        if len(queries) > global_settings.MAX_COUNT_QUERIES:
+            raise django.forms.ValidationError(
+                django.utils.translation.ugettext('At most %d queries are allowed.') % global_settings.MAX_COUNT_QUERIES
+            )
+        return queries
+
+class CountInfo(object):
+
+    def __init__(self, n, query):
+        self.n = n
+        self.query = query
+        self.n_stored_results = self.n_spotted_results = None
+        self.status = None
+
+def count_query(connection, locale, settings, corpus, cinfo):
+    '''
+    Count results of the query, without fetching any of them, going through
+    as many poliqarpd buffers as COUNT_QUERY_TIMEOUT allows.
+
+    Only the connection is touched, so this can be run in a separate thread.
+    '''
+    try:
+        query = syntax.normalize(cinfo.query)
+    except syntax.QuerySyntaxError, ex:
+        cinfo.status = u'error: %s (%d)' % (ex.message, ex.position + 1)
+        return cinfo
+    try:
+        calls = ()
+        if connection.make_session():
+            connection.backend_settings = None
+            calls = get_new_session_calls()
+        sync_settings(locale, settings, connection, calls)
+        connection.open_corpus(corpus.id)
+        connection.make_query(query, force=True)
+        buffer_size = global_settings.BUFFER_SIZE
+        deadline = time.time() + global_settings.COUNT_QUERY_TIMEOUT
+        n_results = 0
+        done = False
+        for n_stored, running in connection.run_buffers(buffer_size, deadline=deadline):
+            if not running:
+                n_results += n_stored
+                done = n_stored < buffer_size
+        if done:
+            cinfo.n_stored_results = cinfo.n_spotted_results = n_results
+            cinfo.status = u'ok'
+        else:
+            # The counts are lower bounds only:
+            cinfo.n_stored_results = n_results
+            if running:
+                cinfo.n_stored_results += n_stored
+            cinfo.n_spotted_results = max(cinfo.n_stored_results, connection.get_n_spotted_results())
+            cinfo.status = u'timeout'
+    except (poliqarp.InvalidQuery, poliqarp.Busy), ex:
+        cinfo.status = u'error: %s' % ex
+    return cinfo
+
+def discard_busy_connections(connections, workers):
+    for key, thread in workers:
+        if thread.isAlive():
+            # The connection is still in use by its thread; don't reuse it,
+            # nor save it with the session:
+            connections.discard(key)
+
+def count_queries(request, settings, corpus, queries):
+    '''
+    Count results of the queries, at most COUNT_CONCURRENCY of them at the
+    same time, each worker over its own connection. Yield results in order
+    of the queries, as soon as they are available.
+    '''
+    connections = get_corpus_connections(request)
+    locale = utils.i18n.get_locale(request.LANGUAGE_CODE)
+    settings_dict = settings.get_dict()
+    todo = Queue.Queue()
+    for n, query in enumerate(queries):
+        todo.put(CountInfo(n, query))
+    done = Queue.Queue()
+    def run(connection):
+        try:
+            while 1:
+                try:
+                    cinfo = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    count_query(connection, locale, settings_dict, corpus, cinfo)
+                except Exception, ex:
+                    # Don't leave the other end waiting.
+                    cinfo.status = u'error: %s' % ex
+                done.put(cinfo)
+            connection.suspend_session()
+        finally:
+            connection.close()
+    n_workers = min(global_settings.COUNT_CONCURRENCY, len(queries))
+    workers = []
+    for i in xrange(n_workers):
+        key = 'count/%s/%d' % (corpus.id, i)
+        connection = connections.get(request, key)
+        thread = threading.Thread(target=run, args=(connection,))
+        thread.setDaemon(True)
+        thread.start()
+        workers.append((key, thread))
+    # count_query() gives up after COUNT_QUERY_TIMEOUT, the rest of this
+    # timeout is for connecting to poliqarpd:
+    timeout = 2 * global_settings.COUNT_QUERY_TIMEOUT
+    finished = {}
+    n = 0
+    while n < len(queries):
+        if n in finished:
+            yield finished.pop(n)
+            n += 1
+            continue
+        try:
+            cinfo = done.get(timeout=timeout)
+        except Queue.Empty:
+            break
+        finished[cinfo.n] = cinfo
+    else:
+        # The connections are saved with the session once this is over, so
+        # let the workers suspend and close them first.
+        deadline = time.time() + timeout
+        for key, thread in workers:
+            thread.join(max(deadline - time.time(), 0))
+        discard_busy_connections(connections, workers)
+        return
+    # A worker hangs, presumably on an unresponsive poliqarpd. Queries not
+    # started yet are dropped, and all the unfinished ones are reported as
+    # timed out.
+    while 1:
+        try:
+            todo.get_nowait()
+        except Queue.Empty:
+            break
+    discard_busy_connections(connections, workers)
+    while 1:
+        try:
+            cinfo = done.get_nowait()
+        except Queue.Empty:
+            break
+        finished[cinfo.n] = cinfo
+    for n in xrange(n, len(queries)):
+        cinfo = finished.get(n)
+        if cinfo is None:
+            cinfo = CountInfo(n, queries[n])
+            cinfo.status = u'timeout'
+        yield cinfo
+
+def _tsv_field(value):
+    if value is None:
+        return u''
+    return unicode(value).replace(u'\t', u' ')
+
+def stream_counts(request, settings, corpus, queries):
+    yield '#query\tstored\tspotted\tstatus\n'
+    # The session lock is held by the response, see process_count():
+    for cinfo in count_queries(request, settings, corpus, queries):
+        line = u'\t'.join(_tsv_field(value) for value in (
+            cinfo.query, cinfo.n_stored_results, cinfo.n_spotted_results, cinfo.status
+        ))
+        yield (line + u'\n').encode('UTF-8')
+    request.session.save()
+
+@django.views.decorators.cache.never_cache
+def process_count(request, corpus_id):
+    settings = get_settings(request)
+    template = get_template('count.html')
+    corpus = get_corpus_by_id(corpus_id)
+    if request.method == 'POST':
+        form = CountForm(request.POST, request.FILES)
+    else:
+        form = CountForm()
+    if not form.is_bound or not form.is_valid():
+        context = Context(request, selected=corpus, form=form)
+        return django.http.HttpResponse(template.render(context))
+    lock = lock_session(request)
+    if lock is None:
+        return temporary_overload(request)
+    content = stream_counts(request, settings, corpus, form.cleaned_data['queries'])
+    response = streaming_response(request, content, lock=lock)
+    response['Content-Type'] = 'text/tab-separated-values; charset=UTF-8'
+    response['Content-Disposition'] = 'attachment; filename=%s-counts.tsv' % corpus.id
+    return response
+
+class JobForm(django.forms.Form):
+    max_results = django.forms.IntegerField(
+        min_value=1,
+        max_value=global_settings.MAX_JOB_RESULTS,
+        initial=global_settings.BUFFER_SIZE,
+        widget=django.forms.TextInput(attrs=dict(size=5))
+    )
+
+JOB_STATES = dict((
+    (jobs.QUEUED, ugettext_lazy('queued')),
+    (jobs.RUNNING, ugettext_lazy('running')),
+    (jobs.DONE, ugettext_lazy('done')),
+    (jobs.FAILED, ugettext_lazy('failed')),
+))
+
+def process_job_submit(request, corpus_id):
+    settings = get_settings(request)
+    corpus = get_corpus_by_id(corpus_id)
+    query = request.session.get('query')
+    form = JobForm(request.POST)
+    if request.method != 'POST' or query is None or not form.is_valid():
+        url = django.core.urlresolvers.reverse(process_query, kwargs=dict(corpus_id=corpus.id))
+        return django.http.HttpResponseRedirect(url)
+    job = jobs.Job(
+        user=request.META.get('REMOTE_ADDR'),
+        corpus_id=corpus.id,
+        query=query,
+        settings=settings.get_dict(),
+        locale=utils.i18n.get_locale(request.LANGUAGE_CODE),
+        max_results=form.cleaned_data['max_results'],
+    )
+    jobs.save(job)
+    request.session['jobs'] = request.session.get('jobs', []) + [job.id]
+    url = django.core.urlresolvers.reverse(process_job, kwargs=dict(job_id=job.id))
+    return django.http.HttpResponseRedirect(url)
+
+def get_job(job_id):
+    try:
+        return jobs.load(job_id)
+    except jobs.JobDoesNotExist:
+        raise django.http.Http404
+
+@django.views.decorators.cache.never_cache
+def process_job(request, job_id, page_start=0):
+    settings = get_settings(request)
+    template = get_template('job.html')
+    job = get_job(job_id)
+    corpus = get_corpus_by_id(job.corpus_id)
+    qinfo = QueryInfo()
+    qinfo.running = job.active
+    qinfo.n_stored_results = job.n_found
+    l = int(page_start)
+    r = l + settings.results_per_page - 1
+    if job.n_results > 0:
+        page_url_template = reverse_template(process_job, 'page_start', job_id=job.id)
+        l, r = paginate(qinfo, settings, page_url_template, l, r, job.n_results)
+        qinfo.results = make_results(corpus, l, jobs.load_results(job, l, r), settings, url_template='#r%d')
+        corpus.enhance_results(qinfo.results)
+    context = Context(request, job=job, job_state=JOB_STATES[job.state], job_failed=(job.state == jobs.FAILED),
+        job_corpus=corpus, qinfo=qinfo)
+    response = django.http.HttpResponse(template.render(context))
+    if job.active:
+        response['Refresh'] = str(global_settings.JOB_PROGRESS_INTERVAL)
+    return response
+
+@django.views.decorators.cache.never_cache
+def process_jobs(request):
+    template = get_template('jobs.html')
+    job_list = []
+    for job_id in request.session.get('jobs', []):
+        try:
+            job = jobs.load(job_id)
+        except jobs.JobDoesNotExist:
+            continue
+        job.corpus = get_corpus_by_id(job.corpus_id)
+        job.state_label = JOB_STATES[job.state]
+        job_list.append(job)
+    context = Context(request, selected='jobs', jobs=job_list)
+    return django.http.HttpResponse(template.render(context))
+
 class SettingsForm(django.forms.Form):
     random_sample = django.forms.BooleanField(required=False)
     random_sample_size = django.forms.IntegerField(
@@ -488,6 +2000,10 @@ class SettingsForm(django.forms.Form):
         widget=django.forms.HiddenInput
     )
 
+# What has to be redone after a setting has changed, from the most to the
+# least expensive; each of them implies all these that follow:
+REMAKE_QUERY, RERUN_QUERY, RESORT_RESULTS, REFETCH_ROWS, RERENDER_PAGE = range(5)
+
 class Settings(object):
 
     defaults = dict(
@@ -506,40 +2022,70 @@ class Settings(object):
         results_per_page = 25,
     )
 
-    _dirty = set()
-    def dirty(self, key=None):
-        if key is None:
-            return frozenset(self._dirty)
-        else:
-            return key in self._dirty
-
-    def __delattr__(self, key):
-        if key in self._dirty:
-            self._dirty.remove(key)
-
     def __getattr__(self, key):
         if key in self.defaults:
             value = self.defaults[key]
             object.__setattr__(self, key, value)
             return value
-        if key.startswith('dirty_'):
-            return lambda key=key: self.dirty(key[6:])
-        elif key.startswith('clean_'):
-            return lambda key=key: self.clean(key[6:])
         raise AttributeError
 
     def __setattr__(self, key, value):
         if key.startswith('_'):
             return object.__setattr__(self, key, value)
         if value != getattr(self, key):
-            try:
-                callback = getattr(type(self), 'on_set_%s' % key)
-            except AttributeError:
-                pass
-            else:
-                callback(self, key, value)
+            self.invalidate(self.invalidated_by(key, value))
         object.__setattr__(self, key, value)
-        self._dirty.add(key)
+
+    # What a change of each setting invalidates (see REMAKE_QUERY and
+    # friends), and the setting without which the change doesn't matter:
+    dependencies = dict(
+        # poliqarpd sorts according to the locale:
+        language = (RESORT_RESULTS, 'sort'),
+        # Samples are drawn by marasca itself, see get_sample_key():
+        random_sample = (REFETCH_ROWS, None),
+        random_sample_size = (REFETCH_ROWS, 'random_sample'),
+        # Switching sorting off is special-cased in invalidated_by():
+        sort = (RESORT_RESULTS, None),
+        sort_column = (RESORT_RESULTS, 'sort'),
+        sort_type = (RESORT_RESULTS, 'sort'),
+        sort_direction = (RESORT_RESULTS, 'sort'),
+        show_in_match = (RERENDER_PAGE, None),
+        show_in_context = (RERENDER_PAGE, None),
+        left_context_width = (REFETCH_ROWS, None),
+        right_context_width = (REFETCH_ROWS, None),
+        wide_context_width = (REFETCH_ROWS, None),
+        results_per_page = (REFETCH_ROWS, None),
+    )
+
+    def invalidated_by(self, key, value):
+        '''
+        Return what has to be redone if the setting changes to the value, or
+        None if nothing has to.
+        '''
+        if key == 'sort' and not value:
+            # poliqarpd sorts results in place; only running the query
+            # again brings back their original order.
+            return RERUN_QUERY
+        level, condition = self.dependencies[key]
+        if condition is not None and not getattr(self, condition):
+            return
+        return level
+
+    def invalidate(self, level):
+        '''
+        Mark the state of the poliqarpd session as stale.
+
+        Fetched rows and rendered pages don't need to be marked: they are
+        cached under keys made of the settings they depend on.
+        '''
+        if level is None:
+            return
+        if level <= REMAKE_QUERY:
+            self._need_query_remake = True
+        if level <= RERUN_QUERY:
+            self._need_query_rerun = True
+        if level <= RESORT_RESULTS:
+            self._need_sort_rerun = True
 
     _need_query_remake = False
     def need_query_remake(self, value=None):
@@ -562,23 +2108,6 @@ class Settings(object):
     def get_dict(self):
         return dict((key, getattr(self, key)) for key in self.defaults)
 
-    def on_set_random_sample(self, key, value):
-        self._need_query_rerun = True
-        self._need_query_remake = True
-
-    def on_set_random_sample_size(self, key, value):
-        if self.random_sample:
-            self._need_query_rerun = True
-
-    def on_set_sort(self, key, value):
-        if value == True:
-            self._need_query_resort = True
-
-    def on_sort_ex(self, key, value):
-        if self.sort:
-            self.need_query_resort = True
-    on_sort_column = on_sort_type = on_sort_direction = on_sort_ex
-
     def __repr__(self):
         return '<%s.%s with %s>' % (
             self.__module__,
@@ -618,13 +2147,16 @@ def process_settings(request):
     form_data['next'] = next
     form = SettingsForm(form_data)
     if request.method == 'POST' and form.is_valid():
+        old_values = settings.get_dict()
         for key, value in form.cleaned_data.iteritems():
             if key == 'next':
                 continue
             if value is None:
                 continue
+            # What this invalidates is worked out by Settings.invalidated_by():
             setattr(settings, key, value)
-        request.session.save()
+        if settings.get_dict() != old_values:
+            request.session.save()
         if is_local_url(next):
             return django.http.HttpResponseRedirect(next)
     context = Context(request, form=form, selected='settings')
@@ -678,7 +2210,14 @@ def process_ping(request):
             t1 = time.time()
             connection.ping()
             t2 = time.time()
-        response = django.http.HttpResponse('%.2f ms' % ((t2 - t1) * 1000))
+        lines = ['%.2f ms' % ((t2 - t1) * 1000)]
+        for backend in utils.routing.router.backends:
+            lines.append('%s: %s, %s' % (
+                backend,
+                backend.healthy and 'up' or 'down',
+                backend.latency is None and 'n/a' or '%.2f ms' % (backend.latency * 1000),
+            ))
+        response = django.http.HttpResponse('\n'.join(lines))
         response['Content-Type'] = 'text/plain'
         return response
 
@@ -13,6 +13,7 @@
 
 from __future__ import with_statement
 
+import glob
 import mmap
 import os
 import struct
@@ -20,6 +21,7 @@ import struct
 import poliqarp
 
 import django.utils.datastructures
+import django.utils.translation
 from django.utils.translation import ugettext_lazy
 
 class Map(object):
@@ -33,7 +35,7 @@ class Map(object):
 
     def __getitem__(self, n):
         rsize = self._rsize
-        chunk = ''.join(self._map[x] for x in xrange(n * rsize, (n + 1) * rsize))
+        chunk = self._map[n * rsize:(n + 1) * rsize]
         result = struct.unpack(self._format, chunk)
         if len(result) == 1:
             return result[0]
@@ -57,23 +59,121 @@ class Map(object):
     def __del__(self):
         self.close()
 
+class MetadataEnhancer(object):
+
+    '''
+    Turns raw metadata tuples into a SortedDict of translated labels and
+    values lists.
+
+    Fields are given as (label, key, value translations) triples, where key
+    None stands for the earliest date found in metadata. Which slot each key
+    goes to, and translations for each language, are worked out only once.
+    '''
+
+    def __init__(self, fields):
+        self._labels = [label for (label, key, translations) in fields]
+        self._translations = [translations for (label, key, translations) in fields]
+        self._slots = {}
+        self._date_slot = None
+        for i, (label, key, translations) in enumerate(fields):
+            if key is None:
+                self._date_slot = i
+            else:
+                self._slots[key] = i
+        self._tables = {}
+
+    def _get_tables(self):
+        language = django.utils.translation.get_language()
+        try:
+            return self._tables[language]
+        except KeyError:
+            pass
+        labels = [unicode(label) for label in self._labels]
+        translations = [
+            (i, dict((key, unicode(value)) for (key, value) in table.iteritems()))
+            for (i, table) in enumerate(self._translations)
+            if table
+        ]
+        tables = self._tables[language] = labels, translations
+        return tables
+
+    def _enhance(self, tuples, tables):
+        labels, translations = tables
+        slots = self._slots
+        values = [[] for label in labels]
+        date = None
+        for key, value in tuples:
+            if isinstance(value, poliqarp.Date):
+                if date is None or value < date:
+                    date = value
+            else:
+                i = slots.get(key)
+                if i is not None:
+                    values[i].append(value)
+        if date is not None and self._date_slot is not None:
+            values[self._date_slot].append(date)
+        for i, table in translations:
+            if values[i]:
+                values[i] = [table.get(value, value) for value in values[i]]
+        result = django.utils.datastructures.SortedDict()
+        for label, value in zip(labels, values):
+            if value:
+                result[label] = value
+        return result
+
+    def __call__(self, tuples):
+        return self._enhance(tuples, self._get_tables())
+
+    def enhance_many(self, tuple_lists):
+        tables = self._get_tables()
+        return [self._enhance(tuples, tables) for tuples in tuple_lists]
+
 class Corpus(object):
 
     has_metadata = False
     has_interps = True
 
+    # Binary index files read by the corpus_statistics management command,
+    # as (path suffix, struct format, field) triples; field is the position
+    # of the interesting value in a record, or None for single-value records.
+    # A segment index has one record per segment, holding the id of the
+    # segment's tag; a document index has one record per document, holding
+    # its first segment. The tag dictionary is given as (strings file suffix,
+    # offsets file suffix, offset format). Layouts differ between corpora,
+    # so there are no defaults.
+    segment_index = None
+    document_index = None
+    tag_dictionary = None
+
     def __init__(self, id, title, path=None, public=True):
         self.id = id
         self.title = title
         self.path = path
         self.public = public
 
+    def get_version(self):
+        '''
+        Return modification time of the newest index file, or None.
+        '''
+        if self.path is None:
+            return
+        mtimes = []
+        for path in glob.glob(self.path + '.*'):
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                pass
+        return max(mtimes or [None])
+
     def enhance_results(self, results):
         return
 
     def enhance_metadata(self, metadata):
         return metadata
 
+    def enhance_metadata_batch(self, metadata_list):
+        return map(self.enhance_metadata, metadata_list)
+
 class OldIpiCorpus(Corpus):
 
     has_metadata = True
@@ -111,29 +211,27 @@ class OldIpiCorpus(Corpus):
     def i18n_medium(self, value):
         return self._i18n_medium.get(value, value)
 
+    _metadata_fields = [
+        (ugettext_lazy('author'), u'autor', None),
+        (ugettext_lazy('title'), u'tytuł', None),
+        (ugettext_lazy('date'), None, None),
+        (ugettext_lazy('publisher'), u'wydawca', None),
+        (ugettext_lazy('place of publication'), u'miejsce wydania', None),
+        (ugettext_lazy('style'), u'styl', _i18n_style),
+        (ugettext_lazy('medium'), u'medium', _i18n_medium),
+    ]
+
+    _metadata_enhancer = None
+
+    def get_metadata_enhancer(self):
+        if self._metadata_enhancer is None:
+            self._metadata_enhancer = MetadataEnhancer(self._metadata_fields)
+        return self._metadata_enhancer
+
     def enhance_metadata(self, tuples):
-        metadata = django.utils.datastructures.MultiValueDict()
-        date = future_date = poliqarp.Date(9999, 1, 1)
-        for key, value in tuples:
-            if isinstance(value, poliqarp.Date):
-                date = min(date, value)
-            else:
-                metadata.appendlist(key, value)
-        if date == future_date:
-            date = None
-        items = [
-            (ugettext_lazy('author'), metadata.getlist('autor')),
-            (ugettext_lazy('title'), metadata.getlist(u'tytuł')),
-            (ugettext_lazy('date'), [date] if date is not None else []),
-            (ugettext_lazy('publisher'), metadata.getlist('wydawca')),
-            (ugettext_lazy('place of publication'), metadata.getlist('miejsce wydania')),
-            (ugettext_lazy('style'), map(self.i18n_style, metadata.getlist('styl'))),
-            (ugettext_lazy('medium'), map(self.i18n_medium, metadata.getlist('medium'))),
-        ]
-        result = django.utils.datastructures.SortedDict()
-        for key, value in items:
-            if value:
-                result[key] = value
-        return result
+        return self.get_metadata_enhancer()(tuples)
+
+    def enhance_metadata_batch(self, tuples_list):
+        return self.get_metadata_enhancer().enhance_many(tuples_list)
 
 # vim:ts=4 sw=4 et
@@ -0,0 +1,208 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+'''
+Corpus-level statistics, computed from binary index files of a corpus.
+
+Which files are read, and how, is described by the corpus's segment_index,
+document_index and tag_dictionary attributes; see corpus.Corpus.
+'''
+
+from __future__ import with_statement
+
+import array
+import cPickle as pickle
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+
+import corpus as corpus_module
+
+class Statistics(object):
+
+    def __init__(self, n_segments, tags, document_lengths):
+        self.n_segments = n_segments
+        # Tag name (or id, if there is no tag dictionary) → number of segments:
+        self.tags = tags
+        # Number of segments in each document, as array('I'):
+        self.document_lengths = document_lengths
+
+    @property
+    def n_documents(self):
+        return len(self.document_lengths)
+
+    @property
+    def mean_document_length(self):
+        if not self.document_lengths:
+            return
+        return float(sum(self.document_lengths)) / len(self.document_lengths)
+
+    def top_tags(self, n):
+        tags = sorted(self.tags.iteritems(), key=lambda item: -item[1])[:n]
+        return [(tag, count, self.relative_frequency(count)) for (tag, count) in tags]
+
+    def relative_frequency(self, count):
+        '''
+        Return the number of occurrences per million segments.
+        '''
+        if not self.n_segments:
+            return
+        return count * 1e6 / self.n_segments
+
+def get_statistics_path(corpus):
+    return os.path.join(settings.CORPUS_STATISTICS_DIRECTORY, '%s.stats' % corpus.id)
+
+def _get_index_path(corpus, suffix):
+    return corpus.path + suffix
+
+def _count_records(path, format):
+    return os.path.getsize(path) // struct.calcsize(format)
+
+def split_range(n, n_parts):
+    '''
+    Split range(n) into at most n_parts (start, stop) pairs of similar size.
+    '''
+    if n == 0:
+        return []
+    n_parts = max(min(n_parts, n), 1)
+    bounds = [n * i // n_parts for i in xrange(n_parts + 1)]
+    return zip(bounds[:-1], bounds[1:])
+
+def count_tags(args):
+    '''
+    Count tag ids of segments in the given range of records.
+    '''
+    path, format, field, start, stop = args
+    map = corpus_module.Map(path, format)
+    counts = {}
+    try:
+        for n in xrange(start, stop):
+            tag = map[n]
+            if field is not None:
+                tag = tag[field]
+            counts[tag] = counts.get(tag, 0) + 1
+    finally:
+        map.close()
+    return counts
+
+def measure_documents(args):
+    '''
+    Compute lengths of documents in the given range of records, each of which
+    holds the first segment of a document.
+    '''
+    path, format, field, start, stop, n_segments = args
+    map = corpus_module.Map(path, format)
+    n_documents = _count_records(path, format)
+    lengths = array.array('I')
+    try:
+        def first_segment(n):
+            if n >= n_documents:
+                return n_segments
+            record = map[n]
+            if field is not None:
+                record = record[field]
+            return record
+        begin = first_segment(start)
+        for n in xrange(start, stop):
+            end = first_segment(n + 1)
+            lengths.append(end - begin)
+            begin = end
+    finally:
+        map.close()
+    return lengths
+
+def read_dictionary(corpus):
+    '''
+    Return the list of strings of the tag dictionary: a file of NUL-terminated
+    strings and a file of their offsets.
+    '''
+    image_suffix, offset_suffix, offset_format = corpus.tag_dictionary
+    offsets_path = _get_index_path(corpus, offset_suffix)
+    n = _count_records(offsets_path, offset_format)
+    if n == 0:
+        return []
+    offsets = corpus_module.Map(offsets_path, offset_format)
+    with open(_get_index_path(corpus, image_suffix), 'rb') as file:
+        image = mmap.mmap(file.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ)
+    try:
+        strings = []
+        for i in xrange(n):
+            offset = offsets[i]
+            end = image.find('\0', offset)
+            if end < 0:
+                end = len(image)
+            strings.append(image[offset:end].decode('UTF-8'))
+        return strings
+    finally:
+        image.close()
+        offsets.close()
+
+def compute(corpus, pool, n_parts):
+    '''
+    Compute statistics of the corpus, using pool.map() to scan parts of the
+    index files in parallel.
+    '''
+    suffix, format, field = corpus.segment_index
+    path = _get_index_path(corpus, suffix)
+    n_segments = _count_records(path, format)
+    tags = {}
+    jobs = [(path, format, field, start, stop) for (start, stop) in split_range(n_segments, n_parts)]
+    for counts in pool.map(count_tags, jobs):
+        for tag, count in counts.iteritems():
+            tags[tag] = tags.get(tag, 0) + count
+    if corpus.tag_dictionary is not None:
+        names = read_dictionary(corpus)
+        tags = dict((names[tag] if 0 <= tag < len(names) else tag, count) for (tag, count) in tags.iteritems())
+    document_lengths = array.array('I')
+    if corpus.document_index is not None:
+        suffix, format, field = corpus.document_index
+        path = _get_index_path(corpus, suffix)
+        n_documents = _count_records(path, format)
+        jobs = [(path, format, field, start, stop, n_segments) for (start, stop) in split_range(n_documents, n_parts)]
+        for lengths in pool.map(measure_documents, jobs):
+            document_lengths.extend(lengths)
+    return Statistics(n_segments, tags, document_lengths)
+
+def save(corpus, statistics):
+    path = get_statistics_path(corpus)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(statistics, file, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def load(corpus):
+    '''
+    Return statistics of the corpus, or None if they haven't been computed.
+    '''
+    path = get_statistics_path(corpus)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return
+    with _cache_lock:
+        cached = _cache.get(corpus.id)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    with open(path, 'rb') as file:
+        statistics = pickle.load(file)
+    with _cache_lock:
+        _cache[corpus.id] = (mtime, statistics)
+    return statistics
+
+# vim:ts=4 sw=4 et
@@ -8,6 +8,13 @@ function update_random_sample_widgets(event)
     $('#id_random_sample_size').attr('disabled', !$('#id_random_sample').attr('checked'));
 }
 
+function start_keepalive(url, interval)
+{
+    setInterval(function() {
+        $.ajax({ url: url, cache: false });
+    }, interval);
+}
+
 $(document).ready(function() {
     $("a[rel]").tooltip({ 
         bodyHandler: function() { 
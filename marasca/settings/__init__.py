@@ -21,6 +21,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'app.slowlog.SlowQueryMiddleware',
 )
 
 if DEBUG:
@@ -36,6 +37,7 @@ TEMPLATE_DIRS = (
 
 INSTALLED_APPS = (
     'django.contrib.sessions',
+    'app',
 )
 
 SESSION_ENGINE = 'django.contrib.sessions.backends.file'
@@ -66,13 +68,91 @@ SESSION_LOCK_TIMEOUT = 5
 
 BUFFER_SIZE = 1000
 NOTIFICATION_INTERVAL = 10
-MAX_RANDOM_SAMPLE_SIZE = BUFFER_SIZE
+# Random samples are drawn while scanning through all the results, so their
+# size is not limited by BUFFER_SIZE; all of the sample is kept in the session.
+MAX_RANDOM_SAMPLE_SIZE = 10000
 MAX_RESULTS_PER_PAGE = 1000
+# Pages with at least this many results are sent while being rendered,
+# STREAM_CHUNK_SIZE results at a time (keep it even, so that row colours
+# keep alternating), compressed if the browser accepts gzip and STREAM_GZIP
+# is true.
+STREAM_RESULTS_THRESHOLD = 200
+STREAM_CHUNK_SIZE = 50
+STREAM_GZIP = True
 QUERY_TIMEOUT = 0.5
+# Once a query has been found to be still running, the pending page polls
+# for its results, and query views don't wait for it:
+PENDING_QUERY_TIMEOUT = 0
+# How long query views wait for a session in use by another request, before
+# handing the wait over to the browser:
+QUERY_SESSION_LOCK_TIMEOUT = 0.5
+
+# How long to wait for a query in each corpus, when searching several corpora
+# at the same time.
+MULTI_QUERY_TIMEOUT = 10
+
+# Counting results of a list of queries: at most MAX_COUNT_QUERIES queries,
+# COUNT_CONCURRENCY of them at the same time, each one given
+# COUNT_QUERY_TIMEOUT seconds to go through as many buffers as it can.
+MAX_COUNT_QUERIES = 100
+COUNT_CONCURRENCY = 4
+COUNT_QUERY_TIMEOUT = 10
+
+# Number of results (with their wide contexts and metadata) kept per session,
+# so that moving between result detail pages doesn't need to ask poliqarpd;
+# and number of sessions whose results are kept, per process.
+RESULT_CACHE_SIZE = 100
+RESULT_CACHE_SESSIONS = 100
+
+# Results of finished queries are stored here, so that they can be paged
+# through without poliqarpd. Set to None to disable. A query is spooled
+# a poliqarpd buffer at a time, up to SPOOL_MAX_RESULTS results (or only its
+# first buffer, if sorting is on), if that takes at most SPOOL_TIMEOUT
+# seconds. Spools older than SPOOL_LIFETIME seconds are removed by the
+# run_jobs management command, every SPOOL_CLEANUP_INTERVAL seconds.
+SPOOL_DIRECTORY = '../spool/'
+SPOOL_MAX_RESULTS = 100 * BUFFER_SIZE
+SPOOL_TIMEOUT = 5
+SPOOL_LIFETIME = 24 * 60 * 60
+SPOOL_CLEANUP_INTERVAL = 60 * 60
+
+# Corpus statistics, see the corpus_statistics management command:
+CORPUS_STATISTICS_DIRECTORY = '../statistics/'
+CORPUS_STATISTICS_TOP_TAGS = 20
+
+# Background query jobs, see the run_jobs management command:
+JOBS_DIRECTORY = '../jobs/'
+MAX_JOB_RESULTS = 100 * BUFFER_SIZE
+JOB_WORKERS = 4
+# Workers that are kept for jobs with interactive priority:
+JOB_INTERACTIVE_WORKERS = 1
+JOB_POLL_INTERVAL = 1
+JOB_PROGRESS_INTERVAL = 5
+JOB_RETRY_INTERVAL = 60
+JOB_LIFETIME = 7 * 24 * 60 * 60
+
+# Additional poliqarpd instances, as (host, port) pairs. Sessions are spread
+# across them by consistent hashing of session names. Empty means a single
+# poliqarpd, with default connection parameters.
+POLIQARPD_BACKENDS = ()
+POLIQARPD_VIRTUAL_NODES = 64
+POLIQARPD_HEALTH_CHECK_INTERVAL = 10
+# A backend is considered down after this many failed health checks in a row;
+# a check fails if ping takes longer than POLIQARPD_MAX_LATENCY seconds.
+POLIQARPD_MAX_FAILURES = 2
+POLIQARPD_MAX_LATENCY = 1.0
+
+# Query requests which take longer than SLOW_QUERY_THRESHOLD seconds are
+# logged here; see the slow_queries management command. The log is shared by
+# all processes and is not rotated by marasca; use e.g. logrotate. Set to
+# None to disable.
+SLOW_QUERY_LOG = '../logs/slow-queries.log'
+SLOW_QUERY_THRESHOLD = 2.0
 
 # By default poliqarpd restricts life-time of an idle session to 1200 seconds.
 # See max-session-idle setting in poliqarpd(1).
-# This value should be *lower* than that one.
+# Pages with query results touch the session in this interval (in seconds),
+# so this value should be *lower* than that one.
 SESSION_REFRESH = 1000
 
 try:
@@ -36,6 +36,7 @@ from utils import redirect
 urlpatterns = patterns('',
     # technical stuff
     url(r'^ping/', views.process_ping),
+    url(r'^keepalive/$', views.process_keepalive, name='keepalive'),
     url(r'^redirect/(?P<key>[A-Za-z0-9_-]+)/(?P<scheme>http)/(?P<tail>.*)$', redirect.safe_redirect),
     url(r'^i18n/set-language/', views.set_language),
     # media
@@ -46,11 +47,17 @@ urlpatterns = patterns('',
     url(r'^$', views.process_index),
     url(r'^settings/$', views.process_settings, name='settings'),
     url(r'^help/$', views.process_cheatsheet, name='help'),
+    url(r'^multi-query/$', views.process_multi_query, name='multi-query'),
+    url(r'^jobs/$', views.process_jobs, name='jobs'),
+    url(r'^jobs/(?P<job_id>[0-9a-f]+)/$', views.process_job, name='job'),
+    url(r'^jobs/(?P<job_id>[0-9a-f]+)/(?P<page_start>[0-9]+)[+]/$', views.process_job, name='job'),
     url(r'^(?P<corpus_id>[\w-]+)/$', views.corpus_info, name='corpus'),
     url(r'^(?P<corpus_id>[\w-]+)/query/(?P<page_start>[0-9]+)[+]/$', views.process_query, dict(query=True), name='query'),
     url(r'^(?P<corpus_id>[\w-]+)/query/(?P<nth>[0-9]+)/$', views.process_query, dict(query=True), name='query'),
     url(r'^(?P<corpus_id>[\w-]+)/query/$', views.process_query, dict(query=True), name='query'),
     url(r'^(?P<corpus_id>[\w-]+)/query/(?:[0-9]+[+]?/)?m(?P<nth>[0-9]+)/$', views.process_metadata_snippet),
+    url(r'^(?P<corpus_id>[\w-]+)/jobs/$', views.process_job_submit, name='submit-job'),
+    url(r'^(?P<corpus_id>[\w-]+)/count/$', views.process_count, name='count'),
     url(r'^error/404/', *template_view(template='404.html')),
     url(r'^error/500/', *template_view(template='500.html')),
 )
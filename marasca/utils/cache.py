@@ -0,0 +1,59 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+class BoundedCache(object):
+
+    '''
+    Mapping that keeps at most `size` recently used items.
+    '''
+
+    def __init__(self, size):
+        self._size = size
+        self._data = {}
+        self._order = []
+
+    def _touch(self, key):
+        self._order.remove(key)
+        self._order.append(key)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            return default
+        self._touch(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self._touch(key)
+        else:
+            self._order.append(key)
+        self._data[key] = value
+        while len(self._order) > self._size:
+            del self._data[self._order.pop(0)]
+
+    def values(self):
+        return self._data.values()
+
+    def clear(self):
+        self._data.clear()
+        del self._order[:]
+
+# vim:ts=4 sw=4 et
@@ -19,6 +19,12 @@ import time
 
 from django.conf import settings
 
+class SessionLocked(OSError):
+
+    '''
+    The session is in use by another request.
+    '''
+
 class SessionLock(object):
 
     def __init__(self, session, wait=None):
@@ -28,13 +34,15 @@ class SessionLock(object):
         else:
             self._wait = wait
 
-    def __enter__(self):
+    def acquire(self):
         while 1:
             try:
                 self._fd = os.open(self._filename, os.O_CREAT | os.O_RDWR | os.O_EXCL, 0600)
             except OSError, ex:
-                if ex.errno != errno.EEXIST or self._wait <= 0:
+                if ex.errno != errno.EEXIST:
                     raise
+                if self._wait <= 0:
+                    raise SessionLocked(ex.errno, ex.strerror, self._filename)
                 sleep = random.random()
                 if sleep > self._wait:
                     sleep = self._wait
@@ -43,8 +51,47 @@ class SessionLock(object):
             else:
                 break
 
-    def __exit__(self, ex_type, ex_value, ex_traceback):
+    def release(self):
         os.unlink(self._filename)
         os.close(self._fd)
 
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, ex_type, ex_value, ex_traceback):
+        self.release()
+
+class LockedIterator(object):
+
+    '''
+    Iterator over a streamed response, which holds an acquired session lock
+    until the response is finished or closed.
+    '''
+
+    def __init__(self, lock, iterable):
+        self._lock = lock
+        self._iterator = iter(iterable)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self._iterator.next()
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        if self._lock is None:
+            return
+        try:
+            close = getattr(self._iterator, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            lock = self._lock
+            self._lock = None
+            lock.release()
+
 # vim:ts=4 sw=4 et
@@ -0,0 +1,185 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+'''
+Routing of poliqarpd sessions across several poliqarpd instances.
+'''
+
+import bisect
+import hashlib
+import struct
+import threading
+import time
+
+import poliqarp
+
+from django.conf import settings
+
+def _hash(s):
+    if isinstance(s, unicode):
+        s = s.encode('UTF-8')
+    [result] = struct.unpack('>I', hashlib.md5(s).digest()[:4])
+    return result
+
+class Backend(object):
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.healthy = True
+        self.failures = 0
+        self.latency = None
+
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+    def __str__(self):
+        return '%s:%d' % self.address
+
+class HashRing(object):
+
+    '''
+    Consistent hashing: each backend owns a number of points on a circle;
+    a key belongs to the first backend clockwise from the key's hash.
+    '''
+
+    def __init__(self, backends, replicas):
+        points = []
+        for backend in backends:
+            for i in xrange(replicas):
+                points.append((_hash('%s#%d' % (backend, i)), backend))
+        points.sort(key=lambda point: point[0])
+        self._hashes = [h for (h, backend) in points]
+        self._backends = [backend for (h, backend) in points]
+
+    def iter_backends(self, key):
+        '''
+        Iterate over distinct backends in order of preference for the key.
+        '''
+        if not self._backends:
+            return
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen = set()
+        n = len(self._backends)
+        for i in xrange(start, start + n):
+            backend = self._backends[i % n]
+            if backend not in seen:
+                seen.add(backend)
+                yield backend
+
+class _HealthCheckConnection(poliqarp.Connection):
+
+    def __init__(self, backend):
+        self.__session_name = 'health-check/%s' % backend
+        poliqarp.Connection.__init__(self, host=backend.host, port=backend.port)
+
+    def get_default_session_name(self):
+        return self.__session_name
+
+def check(backend):
+    '''
+    Ping the backend; return the round-trip time in seconds.
+    '''
+    connection = _HealthCheckConnection(backend)
+    try:
+        connection.make_session()
+        t1 = time.time()
+        connection.ping()
+        t2 = time.time()
+    finally:
+        connection.close()
+    return t2 - t1
+
+class Router(object):
+
+    '''
+    Router of sessions to healthy backends. Unless told otherwise, backends
+    are checked in a background thread, started when the first session is
+    routed; otherwise, call check_all() to check them.
+    '''
+
+    def __init__(self, addresses, replicas, check_in_background=True):
+        self.backends = [Backend(host, port) for (host, port) in addresses]
+        self._ring = HashRing(self.backends, replicas)
+        self._lock = threading.Lock()
+        self._checker = None
+        self._check_in_background = check_in_background
+
+    def route(self, session_name):
+        '''
+        Return the backend for the session, or None if there is only
+        the default poliqarpd.
+        '''
+        if not self.backends:
+            return
+        self._start_checker()
+        first = None
+        for backend in self._ring.iter_backends(session_name):
+            if backend.healthy:
+                return backend
+            first = first or backend
+        # Nothing is healthy, the first choice is as good as any.
+        return first
+
+    def is_healthy(self, address):
+        for backend in self.backends:
+            if backend.address == address:
+                return backend.healthy
+        # Backend removed from the configuration.
+        return False
+
+    def _record(self, backend, latency):
+        with self._lock:
+            if latency is None or latency > settings.POLIQARPD_MAX_LATENCY:
+                backend.failures += 1
+                if backend.failures >= settings.POLIQARPD_MAX_FAILURES:
+                    backend.healthy = False
+            else:
+                backend.failures = 0
+                backend.healthy = True
+            backend.latency = latency
+
+    def mark_down(self, address):
+        for backend in self.backends:
+            if backend.address == address:
+                with self._lock:
+                    backend.failures = settings.POLIQARPD_MAX_FAILURES
+                    backend.healthy = False
+
+    def check_all(self):
+        for backend in self.backends:
+            try:
+                latency = check(backend)
+            except Exception:
+                latency = None
+            self._record(backend, latency)
+
+    def _run_checker(self):
+        while 1:
+            self.check_all()
+            time.sleep(settings.POLIQARPD_HEALTH_CHECK_INTERVAL)
+
+    def _start_checker(self):
+        if self._checker is not None or len(self.backends) < 2 or not self._check_in_background:
+            return
+        with self._lock:
+            if self._checker is not None:
+                return
+            self._checker = threading.Thread(target=self._run_checker)
+            self._checker.setDaemon(True)
+            self._checker.start()
+
+router = Router(settings.POLIQARPD_BACKENDS, settings.POLIQARPD_VIRTUAL_NODES)
+
+# vim:ts=4 sw=4 et
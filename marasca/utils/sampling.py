@@ -0,0 +1,93 @@
+# encoding=UTF-8
+
+# Copyright © 2009, 2010 Jakub Wilk <jwilk@jwilk.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 dated June, 1991.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+import math
+import random
+
+class Reservoir(object):
+
+    '''
+    Uniform random sample of fixed size drawn from a stream of items of
+    unknown length (Li's algorithm L).
+
+    Items are numbered from 0. Since the algorithm knows in advance which
+    item will be taken next, the caller can skip fetching the others:
+    only items for which wants() is true need to be add()-ed, then
+    seen() tells how many items of the stream were scanned.
+    The sample depends only on the seed and the stream length.
+    '''
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+        self.count = 0
+        self._indices = []
+        self._items = []
+        self._random = random.Random(seed)
+        self._w = None
+        self._next = size
+
+    def _uniform(self):
+        while 1:
+            u = self._random.random()
+            if u > 0.0:
+                return u
+
+    def _advance(self):
+        self._w *= math.exp(math.log(self._uniform()) / self.size)
+        self._next += int(math.log(self._uniform()) / math.log(1.0 - self._w)) + 1
+
+    def filling(self):
+        return len(self._items) < self.size
+
+    def next_wanted(self):
+        if self.filling():
+            return self.count
+        return self._next
+
+    def wants(self, n):
+        return n == self.next_wanted()
+
+    def add(self, n, item):
+        if not self.wants(n):
+            raise ValueError(n)
+        if self.filling():
+            self._indices.append(n)
+            self._items.append(item)
+            if not self.filling():
+                self._w = 1.0
+                self._next = n
+                self._advance()
+        else:
+            i = self._random.randrange(self.size)
+            self._indices[i] = n
+            self._items[i] = item
+            self._advance()
+        self.count = n + 1
+
+    def seen(self, n):
+        '''
+        Record that the first n items of the stream were scanned.
+        '''
+        self.count = max(self.count, n)
+
+    def __len__(self):
+        return len(self._items)
+
+    def items(self):
+        '''
+        Return (n, item) pairs of the current sample, in stream order.
+        '''
+        return sorted(zip(self._indices, self._items), key=lambda pair: pair[0])
+
+# vim:ts=4 sw=4 et